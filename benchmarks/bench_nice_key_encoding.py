@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark: nice_key candidates per second from the old
+uuid4 + base_repr path against dborutils.key_encoding.
+
+    python benchmarks/bench_nice_key_encoding.py
+"""
+
+import os
+import sys
+import timeit
+
+# Import dborutils from this checkout, wherever the script is run from
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+SETUP = """
+from uuid import uuid4
+from dborutils.numpy_excerpt import base_repr
+from dborutils.key_encoding import random_base36, random_base36_batch
+"""
+
+CASES = [
+    ("uuid4 + base_repr", "('yz' + base_repr(uuid4().int, 36).lower())[0:12]", 1),
+    ("random_base36", "'yz' + random_base36(10)", 1),
+    ("random_base36_batch(1000)", "['yz' + d for d in random_base36_batch(1000, 10)]", 1000),
+]
+
+
+def main(repeat=3, number=20000):
+
+    baseline = None
+
+    for name, statement, keys_per_call in CASES:
+
+        calls = max(1, number // keys_per_call)
+        best = min(timeit.repeat(statement, SETUP, repeat=repeat, number=calls))
+        keys_per_second = calls * keys_per_call / best
+        baseline = baseline or keys_per_second
+
+        print "{0:<28} {1:>12,.0f} keys/s  {2:>6.1f}x".format(name, keys_per_second, keys_per_second / baseline)
+
+
+if __name__ == '__main__':
+    main()
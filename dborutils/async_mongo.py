@@ -0,0 +1,182 @@
+import os
+import threading
+import weakref
+from multiprocessing.pool import ThreadPool
+
+# One lock per wrapped collection, shared by every AsyncCollection over it
+_collection_locks = weakref.WeakKeyDictionary()
+_collection_locks_lock = threading.Lock()
+
+
+class MongoExecutor(object):
+    """
+    Bounded thread pool for Mongo round trips. At most concurrency calls are
+    in flight at once; further calls queue until a worker is free. pymongo
+    clients are thread-safe, so one executor can be shared by every
+    NoodleAsyncMongoClient and AsyncCollection in a process; those created
+    without an executor use shared().
+    """
+
+    DEFAULT_CONCURRENCY = 8
+
+    _shared = (None, None)
+    _shared_lock = threading.Lock()
+
+    def __init__(self, concurrency=None):
+
+        self.concurrency = concurrency or self.DEFAULT_CONCURRENCY
+        self._pool = ThreadPool(self.concurrency)
+
+    @classmethod
+    def shared(cls):
+        """The process-wide executor, created on first use and never shared across a fork."""
+
+        with cls._shared_lock:
+
+            pid, executor = cls._shared
+
+            if executor is None or pid != os.getpid():
+
+                executor = cls()
+                cls._shared = (os.getpid(), executor)
+
+            return executor
+
+    @classmethod
+    def close_shared(cls):
+
+        with cls._shared_lock:
+
+            pid, executor = cls._shared
+            cls._shared = (None, None)
+
+        if executor is not None and pid == os.getpid():
+
+            executor.close()
+
+    def submit(self, function, *args, **kwargs):
+        """Schedule function(*args, **kwargs) and return its AsyncResult."""
+
+        return self._pool.apply_async(function, args, kwargs)
+
+    def map(self, function, iterable):
+        """Schedule function for every item and return the AsyncResults in order."""
+
+        return [self.submit(function, item) for item in iterable]
+
+    def close(self):
+
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+
+def gather(results, timeout=None):
+    """Wait for a list of AsyncResults and return their values, re-raising the first failure."""
+
+    return [result.get(timeout) for result in results]
+
+
+class NoodleAsyncMongoClient(object):
+    """
+    Concurrent counterpart to NoodleMongoClient. Every client method is run
+    on the executor and returns an AsyncResult instead of blocking; find()
+    drains its cursor in the worker and yields a list, since cursors must
+    not be shared between threads.
+    """
+
+    def __init__(self, noodle_client, executor=None):
+
+        self.client = noodle_client
+        self.executor = executor or MongoExecutor.shared()
+
+    def find(self, filter, fields=None):
+
+        return self.executor.submit(lambda: list(self.client.find(filter, fields)))
+
+    def __getattr__(self, name):
+
+        attr = getattr(self.client, name)
+
+        if not callable(attr):
+
+            return attr
+
+        def submit(*args, **kwargs):
+
+            return self.executor.submit(attr, *args, **kwargs)
+
+        return submit
+
+
+class AsyncCollection(object):
+    """
+    Runs the hot MongoCollection and NoodleProductionCollection operations
+    on an executor. The collections keep a key index and write counters
+    that are not thread-safe, so calls on one collection run one at a time,
+    even through several AsyncCollections; concurrency comes from
+    overlapping several collections.
+    """
+
+    def __init__(self, collection, executor=None):
+
+        self.collection = collection
+        self.executor = executor or MongoExecutor.shared()
+
+        with _collection_locks_lock:
+
+            self._lock = _collection_locks.setdefault(collection, threading.Lock())
+
+    def _submit(self, name, *args, **kwargs):
+
+        method = getattr(self.collection, name)
+
+        def call():
+
+            with self._lock:
+
+                return method(*args, **kwargs)
+
+        return self.executor.submit(call)
+
+    def get(self, key_value, default=None, fields=None):
+
+        return self._submit("get", key_value, default, fields)
+
+    def get_many(self, keys, fields=None, chunk_size=None):
+        """AsyncResult of a list, so the generator is consumed in the worker."""
+
+        def call():
+
+            with self._lock:
+
+                return list(self.collection.get_many(keys, fields, chunk_size))
+
+        return self.executor.submit(call)
+
+    def contains(self, key):
+
+        return self._submit("__contains__", key)
+
+    def refresh_key_index(self, full=False):
+
+        return self._submit("refresh_key_index", full)
+
+    def insert(self, keys):
+
+        return self._submit("insert", keys)
+
+    def update(self, keys):
+
+        return self._submit("update", keys)
+
+    def delete(self, keys):
+
+        return self._submit("delete", keys)
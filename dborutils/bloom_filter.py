@@ -0,0 +1,63 @@
+import hashlib
+import math
+import struct
+
+
+class BloomFilter(object):
+    """
+    Bit-packed probabilistic set. Membership tests have no false negatives
+    and a false-positive rate of about error_rate until capacity items have
+    been added. The bit array never grows past max_bytes; a cap below what
+    capacity and error_rate call for raises the false-positive rate instead.
+    """
+
+    def __init__(self, capacity, error_rate=0.001, max_bytes=4 * 1024 * 1024):
+
+        bit_count = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+
+        self.capacity = capacity
+        self.bit_count = max(8, min(bit_count, max_bytes * 8))
+        self.hash_count = max(1, int(round(self.bit_count / float(capacity) * math.log(2))))
+
+        self._bits = bytearray((self.bit_count + 7) // 8)
+        self._count = 0
+
+    def _offsets(self, item):
+
+        if isinstance(item, unicode):
+
+            item = item.encode("utf-8")
+
+        # Double hashing: k offsets derived from two 64-bit halves of one digest.
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(item).digest())
+
+        return [(h1 + i * h2) % self.bit_count for i in range(self.hash_count)]
+
+    def add(self, item):
+
+        for offset in self._offsets(item):
+
+            self._bits[offset >> 3] |= 1 << (offset & 7)
+
+        self._count += 1
+
+    def __contains__(self, item):
+
+        return all(self._bits[offset >> 3] & (1 << (offset & 7)) for offset in self._offsets(item))
+
+    def __len__(self):
+
+        return self._count
+
+    def is_full(self):
+
+        return self._count >= self.capacity
+
+    def clear(self):
+
+        self._bits = bytearray(len(self._bits))
+        self._count = 0
+
+    def size_in_bytes(self):
+
+        return len(self._bits)
@@ -0,0 +1,338 @@
+import bisect
+import functools
+import threading
+import time
+from bson import BSON
+from pymongo.cursor import Cursor
+
+try:
+    from pymongo import monitoring
+except ImportError:
+    # Command monitoring only exists from pymongo 3.1 on.
+    monitoring = None
+
+
+# Upper bounds, in milliseconds, of the latency histogram buckets. The last
+# bucket counts everything slower.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def bson_size(document):
+
+    try:
+
+        return len(BSON.encode(document))
+
+    except Exception:
+
+        return 0
+
+
+class OperationStats(object):
+    """Call count, documents, bytes and latency histogram of one operation on one collection."""
+
+    def __init__(self):
+
+        self.calls = 0
+        self.documents = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, seconds, documents=0, size=0):
+
+        self.calls += 1
+        self.documents += documents
+        self.bytes += size
+        self.seconds += seconds
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+    def percentile(self, fraction):
+        """Upper bound in ms of the bucket holding the given fraction of calls, None if above the last."""
+
+        threshold = fraction * self.calls
+        seen = 0
+
+        for bound, count in zip(LATENCY_BUCKETS_MS + (None,), self.histogram):
+
+            seen += count
+
+            if seen >= threshold:
+
+                return bound
+
+        return None
+
+    def as_dict(self):
+
+        return {
+            "calls": self.calls,
+            "documents": self.documents,
+            "bytes": self.bytes,
+            "seconds": self.seconds,
+            "histogram": list(self.histogram),
+        }
+
+
+class MongoStats(object):
+    """
+    Per-operation, per-collection OperationStats for instrumented
+    NoodleMongoClients. Every recorded event is also passed to each sink, a
+    callable taking a dict with operation, collection, seconds, documents
+    and bytes.
+    """
+
+    def __init__(self, sinks=None):
+
+        self._stats = {}
+        self._sinks = list(sinks or [])
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+
+        self._sinks.append(sink)
+
+    def record(self, operation, collection, seconds, documents=0, size=0):
+
+        with self._lock:
+
+            self._stats.setdefault((operation, collection), OperationStats()).record(seconds, documents, size)
+
+        if self._sinks:
+
+            event = {
+                "operation": operation,
+                "collection": collection,
+                "seconds": seconds,
+                "documents": documents,
+                "bytes": size,
+            }
+
+            for sink in self._sinks:
+
+                sink(event)
+
+    def get(self, operation, collection):
+
+        return self._stats.get((operation, collection))
+
+    def snapshot(self):
+
+        with self._lock:
+
+            return {key: stats.as_dict() for key, stats in self._stats.iteritems()}
+
+    def reset(self):
+
+        with self._lock:
+
+            self._stats.clear()
+
+    def report(self):
+        """One line per operation and collection, slowest total first."""
+
+        lines = []
+
+        with self._lock:
+
+            ordered = sorted(self._stats.iteritems(), key=lambda item: item[1].seconds, reverse=True)
+
+            for (operation, collection), stats in ordered:
+
+                p95 = stats.percentile(0.95)
+
+                lines.append("{0:<14} {1:<30} calls={2} docs={3} bytes={4} total={5:.3f}s p95<={6}".format(
+                    operation, collection, stats.calls, stats.documents, stats.bytes, stats.seconds,
+                    "{0}ms".format(p95) if p95 else ">{0}ms".format(LATENCY_BUCKETS_MS[-1])))
+
+        return "\n".join(lines)
+
+
+class InstrumentedCursor(object):
+    """
+    Cursor proxy that times the driver's work while iterating and records
+    it, with the documents and bytes returned, once the cursor is
+    exhausted, closed or garbage collected. count() and indexing are
+    timed and recorded as they happen.
+    """
+
+    def __init__(self, cursor, stats, operation, collection, seconds=0.0):
+
+        self._cursor = cursor
+        self._stats = stats
+        self._operation = operation
+        self._collection = collection
+        self._seconds = seconds
+        self._documents = 0
+        self._bytes = 0
+        self._iterated = False
+        self._recorded = False
+
+    def __iter__(self):
+
+        return self
+
+    def next(self):
+
+        started = time.time()
+        self._iterated = True
+
+        try:
+
+            document = self._cursor.next()
+
+        except StopIteration:
+
+            self._seconds += time.time() - started
+            self._record()
+
+            raise
+
+        self._seconds += time.time() - started
+        self._documents += 1
+        self._bytes += bson_size(document)
+
+        return document
+
+    def _record(self):
+
+        if not self._recorded:
+
+            self._recorded = True
+            self._stats.record(self._operation, self._collection, self._seconds, self._documents, self._bytes)
+
+    def count(self, *args, **kwargs):
+
+        started = time.time()
+        result = self._cursor.count(*args, **kwargs)
+
+        self._stats.record("count", self._collection, time.time() - started, result)
+
+        return result
+
+    def close(self):
+
+        self._cursor.close()
+
+        if self._iterated:
+
+            self._record()
+
+    def __del__(self):
+
+        # A cursor that was never iterated never queried the server.
+        if self.__dict__.get("_iterated"):
+
+            self._record()
+
+    def __getitem__(self, index):
+
+        started = time.time()
+        result = self._cursor[index]
+
+        if result is self._cursor:
+
+            # Slicing narrows the cursor itself; keep it instrumented.
+            return self
+
+        self._seconds += time.time() - started
+        self._documents += 1
+        self._bytes += bson_size(result)
+        self._record()
+
+        return result
+
+    def __getattr__(self, name):
+
+        attr = getattr(self._cursor, name)
+
+        if not callable(attr):
+
+            return attr
+
+        def call(*args, **kwargs):
+
+            result = attr(*args, **kwargs)
+
+            # Keep chained cursor modifiers (sort, batch_size, ...) instrumented.
+            return self if result is self._cursor else result
+
+        return call
+
+
+def instrumented(operation, measure=None):
+    """
+    Time a NoodleMongoClient method once the client has been instrumented.
+    measure(args, kwargs, result) returns the (documents, bytes) of a call.
+    Cursors are wrapped and recorded when exhausted.
+    """
+
+    def decorator(method):
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+
+            stats = self._stats
+
+            if stats is None:
+
+                return method(self, *args, **kwargs)
+
+            started = time.time()
+            result = method(self, *args, **kwargs)
+            seconds = time.time() - started
+
+            if isinstance(result, Cursor):
+
+                return InstrumentedCursor(result, stats, operation, self._collection.name, seconds)
+
+            documents, size = measure(args, kwargs, result) if measure else (0, 0)
+            stats.record(operation, self._collection.name, seconds, documents, size)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+if monitoring is not None:
+
+    class CommandStatsListener(monitoring.CommandListener):
+        """Records every server command the driver reports into a MongoStats."""
+
+        def __init__(self, stats):
+
+            self._stats = stats
+            self._collections = {}
+
+        def started(self, event):
+
+            self._collections[event.request_id] = event.command.get(event.command_name)
+
+        def succeeded(self, event):
+
+            collection = self._collections.pop(event.request_id, None)
+            self._stats.record("command:" + event.command_name, collection, event.duration_micros / 1e6,
+                               size=bson_size(event.reply))
+
+        def failed(self, event):
+
+            collection = self._collections.pop(event.request_id, None)
+            self._stats.record("failed:" + event.command_name, collection, event.duration_micros / 1e6)
+
+
+def register_command_monitoring(stats):
+    """
+    Feed every command of clients created from now on into stats using the
+    driver's command monitoring. Returns False when the installed pymongo
+    has no command monitoring.
+    """
+
+    if monitoring is None:
+
+        return False
+
+    monitoring.register(CommandStatsListener(stats))
+
+    return True
@@ -0,0 +1,40 @@
+import os
+
+# Same alphabet as numpy_excerpt.base_repr(number, 36).lower()
+BASE36_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+# Random bytes are mapped to digits with one str.translate() call. Bytes at
+# or above the largest multiple of 36 are dropped so every digit is equally
+# likely.
+_BYTE_LIMIT = 256 - 256 % len(BASE36_DIGITS)
+_DIGIT_TABLE = ''.join(BASE36_DIGITS[b % len(BASE36_DIGITS)] for b in range(256))
+_REJECTED_BYTES = ''.join(chr(b) for b in range(_BYTE_LIMIT, 256))
+
+
+def random_base36(length):
+    """Return a random base-36 string of length characters."""
+
+    return random_base36_batch(1, length)[0]
+
+
+def random_base36_batch(count, length):
+    """
+    Return count random base-36 strings of length characters, all filled
+    from a single os.urandom() buffer.
+    """
+
+    if length <= 0:
+
+        return [''] * count
+
+    needed = count * length
+    digits = ''
+
+    while len(digits) < needed:
+
+        # Over-draw slightly for the ~1.6% of rejected bytes so one read
+        # almost always suffices.
+        shortfall = needed - len(digits)
+        digits += os.urandom(shortfall + shortfall // 32 + 16).translate(_DIGIT_TABLE, _REJECTED_BYTES)
+
+    return [digits[i:i + length] for i in range(0, needed, length)]
@@ -1,6 +1,16 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from multiprocessing import Pool
 from uuid import uuid1
-from uuid import uuid4
-from numpy_excerpt import base_repr
+from bloom_filter import BloomFilter
+from key_encoding import random_base36_batch
+from bson import ObjectId
+from mongo_client import NoodleMongoClient
+from pymongo.errors import BulkWriteError
 
 
 # Changing this will require DB migrations in both dbor_wip and
@@ -8,22 +18,164 @@ from numpy_excerpt import base_repr
 # across all tables!!!
 NICE_KEY_MAX_LENGTH = 20
 
+# Server error code for a unique index violation
+DUPLICATE_KEY_ERROR = 11000
+
+# Times a document whose new nice_key hit the unique index gets a fresh one
+DUPLICATE_KEY_RETRIES = 3
+
 
 class NoodleKeyService(object):
 
     # This INCLUDES the two-character prefix!
     NICE_KEY_GOAL_LENGTH = 12
 
+    # Number of candidate keys checked per $in query in generate_nice_keys()
+    NICE_KEY_BATCH_SIZE = 1000
+
+    # Sizing of the filter remembering every candidate key already tried
+    GENERATED_KEY_FILTER_CAPACITY = 2000000
+    GENERATED_KEY_FILTER_ERROR_RATE = 0.001
+    GENERATED_KEY_FILTER_MAX_BYTES = 4 * 1024 * 1024
+
+    # Pre-reserved key pool used by take_nice_key()
+    NICE_KEY_RESERVATION_COLLECTION = "nice_key_reservations"
+    NICE_KEY_POOL_SIZE = 1000
+    NICE_KEY_POOL_LOW_WATER_MARK = 250
+
+    # Reservations expire after this many seconds, by then the key is either
+    # written or was lost with its process. Pooled keys are handed out only
+    # during the first half of that window.
+    NICE_KEY_RESERVATION_TTL = 24 * 60 * 60
+
+    # Keys start long enough that the expected number of collisions per key,
+    # estimated from the collection's document count, stays below this.
+    TARGET_EXPECTED_RETRIES = 0.01
+    OCCUPANCY_REFRESH_SECONDS = 300
+
     def __init__(self, source_client=None, destination_client=None):
 
         self.source_client = source_client
+        self.destination_client = None
         self.prefix = None
 
         if destination_client:
             self.destination_client = destination_client
             self.prefix = self.destination_client.get_category_code()
 
-        self._generated_nice_keys = {}
+        self._generated_nice_keys = self._new_generated_key_filter(self.GENERATED_KEY_FILTER_CAPACITY)
+        self._generated_key_filter_seeded = False
+        self._write_errors = []
+
+        self._nice_key_pools = {}
+        self._refilling_pools = set()
+        self._nice_key_pool_lock = threading.Lock()
+        self._nice_key_fill_lock = threading.RLock()
+        self._reservation_index_ensured = False
+
+        self._occupancy = {}
+        self._candidate_count = 0
+        self._collision_count = 0
+        self._length_escalation_count = 0
+        self._failed_key_count = 0
+
+    def _new_generated_key_filter(self, capacity):
+
+        return BloomFilter(capacity,
+                           error_rate=self.GENERATED_KEY_FILTER_ERROR_RATE,
+                           max_bytes=self.GENERATED_KEY_FILTER_MAX_BYTES)
+
+    def _remember_nice_key(self, candidate_nice_key):
+        """
+        Record a candidate in the generated key filter, returning False if it
+        (probably) has been seen before.
+        """
+
+        if candidate_nice_key in self._generated_nice_keys:
+
+            return False
+
+        if self._generated_nice_keys.is_full() and not self._generated_key_filter_seeded:
+
+            # Only a local shortcut; the database check still guards uniqueness.
+            self._generated_nice_keys.clear()
+
+        self._generated_nice_keys.add(candidate_nice_key)
+
+        return True
+
+    def seed_generated_key_filter(self):
+        """
+        Load every existing nice_key of the source collection into the
+        generated key filter. As the filter has no false negatives, a
+        candidate it has not seen is unique and the per-candidate database
+        check is skipped from then on; keys written by other processes after
+        seeding are only caught by the collection's unique nice_key index.
+        """
+
+        match = {"nice_key": {"$exists": True}}
+
+        self._generated_nice_keys = self._new_generated_key_filter(
+            self.source_client.count(match) + self.GENERATED_KEY_FILTER_CAPACITY)
+
+        for doc in self.source_client.scan(match, {"nice_key": 1, "_id": 0}, no_timeout=True):
+
+            self._generated_nice_keys.add(doc["nice_key"])
+
+        self._generated_key_filter_seeded = True
+
+    def nice_key_stats(self):
+        """Counters showing how hard it has been to find unique nice_keys."""
+
+        return {
+            "candidates": self._candidate_count,
+            "collisions": self._collision_count,
+            "collision_rate": float(self._collision_count) / self._candidate_count if self._candidate_count else 0.0,
+            "length_escalations": self._length_escalation_count,
+            "failed_keys": self._failed_key_count,
+        }
+
+    def starting_nice_key_length(self, prefix=None, client=None):
+        """
+        Shortest length, from NICE_KEY_GOAL_LENGTH up to NICE_KEY_MAX_LENGTH,
+        at which a random candidate collides with an existing key rarely
+        enough that the expected retries per key stay under
+        TARGET_EXPECTED_RETRIES.
+        """
+
+        prefix = prefix or self.prefix or ""
+        occupied = self._occupied_key_count(client or self.source_client)
+
+        length = NoodleKeyService.NICE_KEY_GOAL_LENGTH
+
+        while length < NICE_KEY_MAX_LENGTH:
+
+            collision_probability = float(occupied) / 36 ** (length - len(prefix))
+
+            # Expected failures before a success for a geometric trial.
+            if collision_probability < 1 and \
+                    collision_probability / (1 - collision_probability) <= self.TARGET_EXPECTED_RETRIES:
+
+                break
+
+            length += 1
+
+        return length
+
+    def _occupied_key_count(self, client):
+
+        if client is None:
+
+            return 0
+
+        counted_at, count = self._occupancy.get(id(client), (None, 0))
+
+        if counted_at is None or time.time() - counted_at > self.OCCUPANCY_REFRESH_SECONDS:
+
+            count = client.count()
+            self._occupancy[id(client)] = (time.time(), count)
+
+        return count
 
     def generate_n_key(self):
 
@@ -39,22 +191,20 @@ class NoodleKeyService(object):
         length_margin = 3
         unique_tries = 10
 
-        curr_goal_len = NoodleKeyService.NICE_KEY_GOAL_LENGTH
-
         prefix = prefix or self.prefix
+
+        curr_goal_len = self.starting_nice_key_length(prefix)
+
         # Try to get key of length [goal_len] up until [goal_len + length_margin]
         for i in range(length_margin):
 
             # Try to obtain unique key maximum of [unique_tries] times
             for j in range(unique_tries):
 
-                # prefix + random 128-bit number compacted to base 36 (a-z,1-9)
-                candidate_nice_key = prefix + base_repr(uuid4().int, 36).lower()
-                candidate_nice_key = candidate_nice_key[0:curr_goal_len]  # Truncate
-
-                if candidate_nice_key not in self._generated_nice_keys:
+                candidate_nice_key = self._candidate_nice_key(prefix, curr_goal_len)
+                self._candidate_count += 1
 
-                    self._generated_nice_keys[candidate_nice_key] = None
+                if self._remember_nice_key(candidate_nice_key):
 
                     if self._is_nice_key_unique(candidate_nice_key):
 
@@ -63,19 +213,288 @@ class NoodleKeyService(object):
 
                         break
 
-            if result:
+                self._collision_count += 1
+
+            if result or curr_goal_len >= NICE_KEY_MAX_LENGTH:
 
                 break
 
             curr_goal_len += 1
+            self._length_escalation_count += 1
+
+        if result is None:
+
+            self._failed_key_count += 1
+
+        return result
+
+    def generate_nice_keys(self, n, prefix=None, client=None):
+        """
+        Generate up to n unique nice keys, checking candidates with one $in
+        query per batch and regenerating only the ones that collide. Uses
+        the same retry limits as generate_nice_key(), so fewer than n keys
+        are returned if those are exhausted. Uniqueness is checked against
+        client, the source client by default.
+        """
+
+        result = []
+
+        length_margin = 3
+        unique_tries = 10
+
+        prefix = prefix or self.prefix
+
+        curr_goal_len = self.starting_nice_key_length(prefix, client=client)
+
+        for i in range(length_margin):
+
+            for j in range(unique_tries):
+
+                needed = n - len(result)
+
+                if not needed:
+
+                    break
+
+                candidates = set()
+
+                for candidate_nice_key in self._candidate_nice_keys(prefix, curr_goal_len, needed):
+
+                    if self._remember_nice_key(candidate_nice_key):
+
+                        candidates.add(candidate_nice_key)
+
+                taken = self._existing_nice_keys(list(candidates), client=client)
+
+                result.extend(c for c in candidates if c not in taken)
+
+                self._candidate_count += needed
+                self._collision_count += needed - len(candidates) + len(taken)
+
+            if len(result) == n or curr_goal_len >= NICE_KEY_MAX_LENGTH:
+
+                break
+
+            curr_goal_len += 1
+            self._length_escalation_count += 1
+
+        self._failed_key_count += n - len(result)
+
+        return result
+
+    def _candidate_nice_key(self, prefix, length):
+
+        return self._candidate_nice_keys(prefix, length, 1)[0]
+
+    def _candidate_nice_keys(self, prefix, length, count):
+
+        if length > NICE_KEY_MAX_LENGTH:
+
+            raise ValueError("nice_key length {0} exceeds NICE_KEY_MAX_LENGTH ({1})".format(
+                length, NICE_KEY_MAX_LENGTH))
+
+        # prefix + random base 36 digits (0-9, a-z) up to the requested length
+        return [prefix + digits for digits in random_base36_batch(count, length - len(prefix))]
+
+    def _existing_nice_keys(self, candidate_nice_keys, client=None):
+        """
+        Return the subset of candidates already used in the mongo collection
+        of client (default source) or sitting reserved in a key pool.
+        """
+
+        result = set()
+
+        client = client or self.source_client
+
+        check_client = not (self._generated_key_filter_seeded and client is self.source_client)
+
+        for i in range(0, len(candidate_nice_keys), self.NICE_KEY_BATCH_SIZE):
+
+            batch = candidate_nice_keys[i:i + self.NICE_KEY_BATCH_SIZE]
+
+            if check_client:
+
+                result.update(d["nice_key"] for d in client.find({"nice_key": {"$in": batch}}, {"nice_key": 1}))
+
+            result.update(self._reserved_nice_keys(batch))
 
         return result
 
     def _is_nice_key_unique(self, candidate_nice_key):
-        """Verify uniqueness against the source mongo collection."""
+        """Verify uniqueness against the source mongo collection and the key pool reservations."""
+
+        if not self._generated_key_filter_seeded and self.source_client.count({"nice_key": candidate_nice_key}):
+
+            return False
+
+        return not self._reserved_nice_keys([candidate_nice_key])
+
+    def take_nice_key(self, prefix=None):
+        """
+        Hand out a nice_key from the pre-reserved pool for prefix. This costs
+        no round trip unless the pool is empty; the pool is topped up in the
+        background once it drops below NICE_KEY_POOL_LOW_WATER_MARK.
+        """
+
+        prefix = prefix or self.prefix
+
+        pool = self._nice_key_pool(prefix)
+
+        nice_key = self._pop_reserved_nice_key(pool)
+
+        if nice_key is None:
+
+            self.fill_nice_key_pool(prefix)
+            nice_key = self._pop_reserved_nice_key(pool)
+
+        if nice_key is None:
+
+            raise Exception("FAILED TO RESERVE KEYS for prefix {0}".format(prefix))
+
+        if len(pool) < self.NICE_KEY_POOL_LOW_WATER_MARK:
+
+            self._fill_nice_key_pool_in_background(prefix)
+
+        return nice_key
+
+    def _pop_reserved_nice_key(self, pool):
+        """Pop the first pooled key whose reservation is not close to expiring, dropping older ones."""
+
+        oldest = datetime.utcnow() - timedelta(seconds=self.NICE_KEY_RESERVATION_TTL / 2)
+
+        while pool:
+
+            nice_key, reserved_at = pool.popleft()
+
+            if reserved_at > oldest:
+
+                return nice_key
+
+        return None
+
+    def _nice_key_pool(self, prefix):
+
+        with self._nice_key_pool_lock:
+
+            return self._nice_key_pools.setdefault(prefix, deque())
+
+    def fill_nice_key_pool(self, prefix=None):
+        """
+        Top the pool for prefix up to NICE_KEY_POOL_SIZE with keys that are
+        unused in the destination collection and reserved in its
+        NICE_KEY_RESERVATION_COLLECTION, whose unique index arbitrates
+        between processes filling pools at the same time. Key generation
+        skips reserved keys, and reservations expire after
+        NICE_KEY_RESERVATION_TTL seconds.
+        """
+
+        prefix = prefix or self.prefix
+
+        pool = self._nice_key_pool(prefix)
+
+        with self._nice_key_fill_lock:
+
+            needed = self.NICE_KEY_POOL_SIZE - len(pool)
+
+            if needed <= 0:
+
+                return
+
+            candidates = self.generate_nice_keys(needed, prefix=prefix, client=self.destination_client)
+
+            pool.extend(self._reserve_nice_keys(candidates, prefix))
+
+    def _fill_nice_key_pool_in_background(self, prefix):
+
+        with self._nice_key_pool_lock:
+
+            if prefix in self._refilling_pools:
+
+                return
+
+            self._refilling_pools.add(prefix)
+
+        def fill():
+
+            try:
+
+                self.fill_nice_key_pool(prefix)
+
+            finally:
+
+                with self._nice_key_pool_lock:
+
+                    self._refilling_pools.discard(prefix)
 
-        return self.source_client.collection() \
-            .find({"nice_key": candidate_nice_key}).count() == 0
+        thread = threading.Thread(target=fill, name="nice-key-pool-{0}".format(prefix))
+        thread.daemon = True
+        thread.start()
+
+    def _reservation_collection(self):
+
+        collection = self.destination_client.database()[self.NICE_KEY_RESERVATION_COLLECTION]
+
+        if not self._reservation_index_ensured:
+
+            collection.ensure_index("nice_key", unique=True)
+            collection.ensure_index("reserved_at", expireAfterSeconds=self.NICE_KEY_RESERVATION_TTL)
+            self._reservation_index_ensured = True
+
+        return collection
+
+    def _reserved_nice_keys(self, nice_keys):
+        """Return the subset of nice_keys reserved in a key pool, by any process."""
+
+        if not self.destination_client:
+
+            return set()
+
+        return {d["nice_key"] for d in self._reservation_collection().find({"nice_key": {"$in": nice_keys}},
+                                                                           {"nice_key": 1})}
+
+    def _reserve_nice_keys(self, nice_keys, prefix):
+        """Insert reservations for nice_keys and return (nice_key, reserved_at) for the ones nobody else had."""
+
+        if not nice_keys:
+
+            return []
+
+        bulk = self._reservation_collection().initialize_unordered_bulk_op()
+
+        # A UTC datetime, the only type the TTL index expires
+        reserved_at = datetime.utcnow()
+
+        for nice_key in nice_keys:
+
+            bulk.insert({"nice_key": nice_key, "prefix": prefix, "reserved_at": reserved_at})
+
+        try:
+
+            bulk.execute()
+            rejected = set()
+
+        except BulkWriteError as e:
+
+            rejected = {nice_keys[error["index"]] for error in e.details.get("writeErrors", [])}
+
+        return [(nice_key, reserved_at) for nice_key in nice_keys if nice_key not in rejected]
+
+    def release_nice_key_pools(self):
+        """Drop the reservations of every key still unused in a pool."""
+
+        with self._nice_key_fill_lock:
+
+            unused = []
+
+            for pool in self._nice_key_pools.values():
+
+                while pool:
+
+                    unused.append(pool.popleft()[0])
+
+            if unused:
+
+                self._reservation_collection().remove({"nice_key": {"$in": unused}}, multi=True)
 
     def update_document_nice_key(self, doc, nice_key):
 
@@ -86,75 +505,354 @@ class NoodleKeyService(object):
                                                        "ids.nice_key": nice_key}},
                                              upsert=False)
 
-    def synchronize_nice_keys(self):
+    def write_errors(self):
+
+        return self._write_errors
+
+    def _write_nice_keys(self, nice_keys_by_id, retry_duplicates=False):
+        """
+        Sets nice_key on the source documents in one bulk write for a list of
+        (ObjectId, nice_key) pairs, reporting what was acknowledged and any
+        per-document errors. With retry_duplicates, duplicate key errors are
+        returned to the caller instead of being reported.
+        """
+
+        duplicates = []
+
+        if not nice_keys_by_id:
+
+            return duplicates
+
+        result = self.source_client.bulk_update(
+            [({"_id": _id}, {"$set": {"nice_key": nice_key, "ids.nice_key": nice_key}})
+             for _id, nice_key in nice_keys_by_id],
+            ordered=False
+        )
+
+        errors = result.get("writeErrors") or []
+
+        print "WROTE {0}/{1} nice_keys, {2} errors".format(
+            result.get("nMatched") or 0, len(nice_keys_by_id), len(errors))
+
+        for error in errors:
+
+            _id, nice_key = nice_keys_by_id[error["index"]]
+
+            if retry_duplicates and error.get("code") == DUPLICATE_KEY_ERROR:
+
+                duplicates.append(error)
+                continue
+
+            print "Failed to set nice_key {0} on ObjectId {1}: {2}".format(nice_key, _id, error.get("errmsg"))
+
+            self._write_errors.append(error)
+
+        return duplicates
+
+    def synchronize_nice_keys(self, batch_size=None, preload_destination=False):
+        """
+        Copy nice_keys from the destination onto source documents that have
+        none, matching on synkey. Destination nice_keys are fetched with one
+        $in query per batch of source documents, or streamed once up front
+        when preload_destination is set. Every synkey must match exactly one
+        destination document; offending synkeys are raised as a KeyError
+        once the rest of their batch has been written.
+        """
+
+        batch_size = batch_size or self.NICE_KEY_BATCH_SIZE
 
         print "Synchronizing empty nice_keys on {0}...".format(self.source_client)
         print "...matching on synkey..."
         print "...using nice_keys from {0}...".format(self.destination_client)
 
-        empty_nice_keys = self.source_client.find({"nice_key": {"$exists": False}}, {"synkey": 1})
+        destination_nice_keys = None
 
-        total_empty_nice_keys = empty_nice_keys.count()
+        if preload_destination:
+
+            destination_nice_keys = self._destination_nice_keys_by_synkey()
+
+        match = {"nice_key": {"$exists": False}}
+
+        total_empty_nice_keys = self.source_client.count(match)
         print "Found {0} documents whose nice_key needs to be synchronized".format(total_empty_nice_keys)
 
         progress_report = "PROCESSED {0}/{1}".format("{0}", total_empty_nice_keys)
 
+        batch = []
+
+        empty_nice_keys = self.source_client.scan(match, {"synkey": 1}, batch_size=batch_size, no_timeout=True)
+
         for ct, source_doc in enumerate(empty_nice_keys):
 
-            dest_doc = self.destination_client.find({"synkey": source_doc["synkey"]}, {"synkey": 1, "nice_key": 1})
+            batch.append(source_doc)
 
-            cnt = dest_doc.count()
-            if cnt == 1:
+            if len(batch) >= batch_size:
 
-                doc = dest_doc[0]
+                self._synchronize_nice_key_batch(batch, destination_nice_keys)
+                batch = []
 
-                nice_key = doc['nice_key']
+            if (ct % 10000 == 0):
+
+                print progress_report.format(ct + 1)
 
-                self.source_client.update(
-                    {"_id": source_doc["_id"]},
-                    {"$set": {"nice_key": nice_key, "ids.nice_key": nice_key}},
-                    upsert=False
-                )
+        self._synchronize_nice_key_batch(batch, destination_nice_keys)
+
+    def _destination_nice_keys_by_synkey(self, synkeys=None):
+        """
+        Return {synkey: [nice_key, ...]} for every destination document, or
+        only for those whose synkey is in synkeys.
+        """
+
+        result = {}
+
+        match = {"synkey": {"$in": synkeys}} if synkeys is not None else {}
+
+        for doc in self.destination_client.scan(match, {"synkey": 1, "nice_key": 1}, no_timeout=True):
+
+            result.setdefault(doc.get("synkey"), []).append(doc.get("nice_key"))
+
+        return result
+
+    def _synchronize_nice_key_batch(self, source_docs, destination_nice_keys=None):
+
+        if not source_docs:
+
+            return
+
+        if destination_nice_keys is None:
+
+            destination_nice_keys = self._destination_nice_keys_by_synkey(
+                list({doc["synkey"] for doc in source_docs}))
+
+        pending = []
+        offending = []
+
+        for source_doc in source_docs:
+
+            nice_keys = destination_nice_keys.get(source_doc["synkey"], [])
+
+            if len(nice_keys) == 1 and nice_keys[0]:
+
+                pending.append((source_doc["_id"], nice_keys[0]))
 
             else:
 
-                raise KeyError("Wrong number of documents matched: {0}".format(cnt))
+                offending.append("{0} ({1})".format(source_doc["synkey"], len(nice_keys)))
 
-            if (ct % 10000 == 0):
+        self._write_nice_keys(pending)
 
-                print progress_report.format(ct + 1)
+        if offending:
 
-    def assign_nice_keys(self):
+            raise KeyError("Wrong number of documents matched for synkeys: {0}".format(", ".join(offending)))
+
+    def assign_nice_keys(self, batch_size=None):
         """
         Iterate through all the empty nice_key documents and assign a
-        nice_key to any documents that do not have one
+        nice_key to any documents that do not have one, generating and
+        writing keys batch_size documents at a time.
         """
 
+        batch_size = batch_size or self.NICE_KEY_BATCH_SIZE
+
         print "Assigning nice_key values to new documents on {0}...".format(self.source_client)
 
-        empty_nice_keys = self.source_client.find({"nice_key": {"$exists": False}}, {"nice_key": 1})
+        match = {"nice_key": {"$exists": False}}
 
-        total_empty_nice_keys = empty_nice_keys.count()
+        total_empty_nice_keys = self.source_client.count(match)
 
         if total_empty_nice_keys:
 
             print "{0} empty nice key docs found".format(total_empty_nice_keys)
             progress_report = "PROCESSED {0}/{1}".format("{0}", total_empty_nice_keys)
 
-            for ct, doc in enumerate(empty_nice_keys):
+            batch = []
+            processed = 0
 
-                nice_key = self.generate_nice_key()
+            empty_nice_keys = self.source_client.scan(match, {"nice_key": 1}, batch_size=batch_size, no_timeout=True)
 
-                if nice_key:
+            for ct, doc in enumerate(empty_nice_keys):
 
-                    self.update_document_nice_key(doc, nice_key)
+                batch.append(doc)
 
-                elif nice_key is None:
+                if len(batch) >= batch_size:
 
-                    raise Exception("FAILED TO GENERATE KEY on doc {0} with ObjectId {1}".format(ct, doc["_id"]))
+                    self._assign_nice_key_batch(batch, processed)
+                    processed += len(batch)
+                    batch = []
 
                 if (ct % 10000 == 0):
 
                     print progress_report.format(ct + 1)
 
-            print progress_report.format(empty_nice_keys.count())
+            if batch:
+
+                self._assign_nice_key_batch(batch, processed)
+
+            print progress_report.format(processed + len(batch))
+
+    def _assign_nice_key_batch(self, docs, offset):
+
+        docs = [doc for doc in docs if doc.get("nice_key", None) is None]
+
+        # A key can be taken by another writer between our uniqueness check
+        # and our write; the unique nice_key index rejects it and the
+        # document gets a fresh key.
+        for attempt in range(DUPLICATE_KEY_RETRIES + 1):
+
+            if not docs:
+
+                break
+
+            nice_keys = self.generate_nice_keys(len(docs))
+
+            if len(nice_keys) < len(docs):
+
+                doc = docs[len(nice_keys)]
+
+                raise Exception("FAILED TO GENERATE KEY on doc {0} with ObjectId {1}".format(
+                    offset + len(nice_keys), doc["_id"]))
+
+            duplicates = self._write_nice_keys([(d["_id"], nice_key) for d, nice_key in zip(docs, nice_keys)],
+                                               retry_duplicates=attempt < DUPLICATE_KEY_RETRIES)
+
+            docs = [docs[error["index"]] for error in duplicates]
+
+    def assign_nice_keys_parallel(self, source_spec, checkpoint_dir, processes=4, batch_size=None):
+        """
+        Assign nice_keys to every empty nice_key document using a pool of
+        worker processes, each with its own client built from source_spec,
+        working through its own _id range of the empty nice_key set.
+
+        Each shard records the last _id it wrote in checkpoint_dir, so running
+        again with the same checkpoint_dir after an interruption resumes every
+        shard where it stopped. The checkpoints are removed once all shards
+        finish. Workers rely on the unique nice_key index, which is ensured
+        here, to keep keys unique across processes.
+        """
+
+        batch_size = batch_size or self.NICE_KEY_BATCH_SIZE
+
+        print "Assigning nice_key values in parallel on {0}...".format(self.source_client)
+
+        self.source_client.ensure_index("nice_key", unique=True)
+
+        if not os.path.isdir(checkpoint_dir):
+
+            os.makedirs(checkpoint_dir)
+
+        shards = self._load_nice_key_shards(checkpoint_dir, processes)
+
+        pending = [(source_spec, self.prefix, shard, checkpoint_dir, batch_size)
+                   for shard in shards if not shard["done"]]
+
+        print "{0} of {1} shards left to process".format(len(pending), len(shards))
+
+        pool = Pool(processes)
+
+        try:
+
+            pool.map(_assign_nice_keys_shard, pending)
+
+        finally:
+
+            pool.close()
+            pool.join()
+
+        for name in os.listdir(checkpoint_dir):
+
+            if name.endswith(".json"):
+
+                os.remove(os.path.join(checkpoint_dir, name))
+
+    def _load_nice_key_shards(self, checkpoint_dir, shard_count):
+
+        shards = []
+
+        for name in sorted(os.listdir(checkpoint_dir)):
+
+            if name.startswith("shard-") and name.endswith(".json"):
+
+                with open(os.path.join(checkpoint_dir, name)) as f:
+
+                    shards.append(json.load(f))
+
+        if not shards:
+
+            ranges = self.source_client.id_ranges({"nice_key": {"$exists": False}}, shard_count)
+
+            for number, (lower, upper) in enumerate(ranges):
+
+                shard = {
+                    "number": number,
+                    "lower": str(lower) if lower else None,
+                    "upper": str(upper) if upper else None,
+                    "last_id": None,
+                    "done": False,
+                }
+
+                _write_nice_key_checkpoint(checkpoint_dir, shard)
+                shards.append(shard)
+
+        return shards
+
+    def _assign_nice_keys_in_shard(self, shard, checkpoint_dir, batch_size):
+
+        id_range = {}
+
+        if shard["last_id"] or shard["lower"]:
+
+            id_range["$gt" if shard["last_id"] else "$gte"] = ObjectId(shard["last_id"] or shard["lower"])
+
+        if shard["upper"]:
+
+            id_range["$lt"] = ObjectId(shard["upper"])
+
+        match = {"nice_key": {"$exists": False}}
+
+        if id_range:
+
+            match["_id"] = id_range
+
+        batches = self.source_client.scan(match, {"nice_key": 1}, batch_size=batch_size, sort="_id",
+                                          no_timeout=True, raw_batches=True)
+
+        processed = 0
+
+        for batch in batches:
+
+            self._assign_nice_key_batch(batch, processed)
+            processed += len(batch)
+
+            shard["last_id"] = str(batch[-1]["_id"])
+            _write_nice_key_checkpoint(checkpoint_dir, shard)
+
+            print "SHARD {0} PROCESSED {1}".format(shard["number"], processed)
+
+        shard["done"] = True
+        _write_nice_key_checkpoint(checkpoint_dir, shard)
+
+        print "SHARD {0} DONE, PROCESSED {1}".format(shard["number"], processed)
+
+        return processed
+
+
+def _write_nice_key_checkpoint(checkpoint_dir, shard):
+
+    path = os.path.join(checkpoint_dir, "shard-{0:04d}.json".format(shard["number"]))
+
+    with open(path + ".tmp", "w") as f:
+
+        json.dump(shard, f)
+
+    os.rename(path + ".tmp", path)
+
+
+def _assign_nice_keys_shard(args):
+    """Worker process entry point for NoodleKeyService.assign_nice_keys_parallel()."""
+
+    source_spec, prefix, shard, checkpoint_dir, batch_size = args
+
+    service = NoodleKeyService(source_client=NoodleMongoClient.create_from_mongo_spec(source_spec))
+    service.prefix = prefix
+
+    return service._assign_nice_keys_in_shard(shard, checkpoint_dir, batch_size)
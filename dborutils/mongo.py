@@ -1,6 +1,48 @@
+import hashlib
+import sys
+import threading
+import time
+from Queue import Queue
 from datetime import datetime
+from .instrumentation import bson_size
 from .key_service import NoodleKeyService
-from bson import ObjectId
+from bson import BSON, ObjectId
+from bson.son import SON
+
+
+# Marks the end of the work handed to a pipeline stage
+_STOP = object()
+
+
+def _chunks(iterable, size):
+
+    chunk = []
+
+    for item in iterable:
+
+        chunk.append(item)
+
+        if len(chunk) >= size:
+
+            yield chunk
+            chunk = []
+
+    if chunk:
+
+        yield chunk
+
+
+def _sorted_son(value):
+
+    if isinstance(value, dict):
+
+        return SON([(key, _sorted_son(value[key])) for key in sorted(value)])
+
+    if isinstance(value, (list, tuple)):
+
+        return [_sorted_son(item) for item in value]
+
+    return value
 
 
 class AbstractDocumentCollection(object):
@@ -50,6 +92,13 @@ class AbstractDocumentCollection(object):
 
 class MongoCollection(AbstractDocumentCollection):
 
+    # Number of keys sent in a single $in query by get_many()
+    GET_MANY_CHUNK_SIZE = 1000
+
+    # Seconds after which the key index is rebuilt from scratch, dropping
+    # keys whose documents were removed by other writers
+    KEY_INDEX_TTL = 300
+
     def __init__(self, noodle_client, key="nice_key", filter=None):
 
         self.mongo = noodle_client
@@ -61,6 +110,13 @@ class MongoCollection(AbstractDocumentCollection):
 
         self.filter = dict(filter or {})
 
+        # key -> _id index, loaded lazily by _load_key_index() and then
+        # refreshed incrementally from the highest _id seen so far.
+        self.key_to_mongo_id = {}
+        self._key_index_loaded = False
+        self._key_index_loaded_at = None
+        self._key_index_watermark = None
+
         self._ensure_indices()
 
         # Merge any supplied filter into the provider_managed version
@@ -71,7 +127,7 @@ class MongoCollection(AbstractDocumentCollection):
                 self.filter,
             ]
         } if self.filter else pm
-        documents = self.mongo.find(pm_filter, {self.key: 1})
+        documents = self.mongo.scan(pm_filter, {self.key: 1})
         self._provider_managed_keys = {d[self.key] for d in documents}
 
     def count(self):
@@ -84,21 +140,89 @@ class MongoCollection(AbstractDocumentCollection):
         Ensures indices on provider_managed
         """
 
-        [self.mongo.ensure_index(field, unique=True) for field in ['nice_key']]
+        self.mongo.ensure_indexes([{"key": field, "unique": True} for field in ['nice_key']])
+
+    def _key_index_filter(self):
+
+        if self._key_index_watermark is None:
+
+            return self.filter
+
+        watermark = {"_id": {"$gt": self._key_index_watermark}}
+
+        return {"$and": [self.filter, watermark]} if self.filter else watermark
+
+    def refresh_key_index(self, full=False):
+        """
+        Brings the key -> _id index up to date. Only documents inserted
+        since the last refresh (_id above the watermark) are read unless
+        full=True, which rebuilds the index from scratch.
+        """
+
+        if full or not self._key_index_loaded:
+
+            self.key_to_mongo_id = {}
+            self._key_index_watermark = None
+            self._key_index_loaded_at = time.time()
+
+        documents = self.mongo.scan(self._key_index_filter(), {self.key: 1}, sort="_id", no_timeout=True)
+
+        for d in documents:
+
+            if self.key in d:
+
+                self.key_to_mongo_id[d[self.key]] = d["_id"]
+
+            self._key_index_watermark = d["_id"]
+
+        self._key_index_loaded = True
+
+    def _load_key_index(self):
+        """
+        Returns the key index, loading it on first use and rebuilding it
+        once it is older than KEY_INDEX_TTL. Between rebuilds the index is
+        authoritative: keys written elsewhere since are only seen after
+        refresh_key_index().
+        """
+
+        if not self._key_index_loaded or time.time() - self._key_index_loaded_at > self.KEY_INDEX_TTL:
+
+            self.refresh_key_index(full=True)
+
+        return self.key_to_mongo_id
 
     def __getitem__(self, key_value, fields=None):
-        find_match = {'_id': ObjectId(
-            {d[self.key]: d['_id'] for d in self.mongo.find(
-                self.filter, {self.key: 1})}[key_value])}
 
-        documents = self.mongo.find(find_match, fields)
-        cnt = documents.count()
+        mongo_id = self._load_key_index().get(key_value)
+
+        if mongo_id is None:
+
+            # Not indexed yet; a single query finds documents written since
+            # the last refresh.
+            match = {self.key: key_value}
+            documents = list(self.mongo.find({"$and": [self.filter, match]} if self.filter else match, fields)
+                             .limit(2))
+
+            if len(documents) != 1:
+
+                raise KeyError("No unique document found for key {0}, found: {1}".format(key_value, len(documents)))
 
-        if cnt == 0 or cnt > 1:
+            if "_id" in documents[0]:
 
-            raise KeyError("No unique document found for key {0}, found: {1}".format(key_value, cnt))
+                self.key_to_mongo_id[key_value] = documents[0]["_id"]
 
-        return documents[0]
+            return documents[0]
+
+        document = self.mongo.find_one({'_id': mongo_id}, fields)
+
+        if document is None:
+
+            # Removed behind our back; forget it so the index stays honest.
+            self.key_to_mongo_id.pop(key_value, None)
+
+            raise KeyError("No unique document found for key {0}, found: {1}".format(key_value, 0))
+
+        return document
 
     def get(self, key_value, default=None, fields=None):
 
@@ -112,16 +236,84 @@ class MongoCollection(AbstractDocumentCollection):
 
         return result
 
+    def get_many(self, keys, fields=None, chunk_size=None):
+        """
+        Yields the documents matching keys using one $in query per chunk of
+        chunk_size keys. Keys with no document are skipped, as with get().
+        Documents are not returned in key order.
+        """
+
+        chunk_size = chunk_size or self.GET_MANY_CHUNK_SIZE
+
+        if isinstance(fields, dict):
+
+            if fields and all(fields.values()):
+
+                fields = dict(fields, **{self.key: 1})
+
+        elif fields is not None:
+
+            fields = list(fields) + [self.key]
+
+        for chunk in _chunks(keys, chunk_size):
+
+            match = {self.key: {"$in": chunk}}
+
+            for document in self.mongo.find({"$and": [self.filter, match]} if self.filter else match, fields):
+
+                if self._key_index_loaded:
+
+                    self.key_to_mongo_id[document[self.key]] = document["_id"]
+
+                yield document
+
+    def _get_many_by_key(self, keys, fields=None):
+        """
+        Returns {key: document} for keys, raising KeyError for any key
+        that does not match exactly one document.
+        """
+
+        result = {}
+        duplicated = set()
+
+        for d in self.get_many(keys, fields=fields):
+
+            if d[self.key] in result:
+
+                duplicated.add(d[self.key])
+
+            result[d[self.key]] = d
+
+        offending = [key for key in keys if key not in result or key in duplicated]
+
+        if offending:
+
+            raise KeyError("No unique document found for keys {0}".format(offending))
+
+        return result
+
     def __contains__(self, key):
-        return key in self.key_to_mongo_id
+        return key in self._load_key_index()
 
     def __iter__(self):
-        for key in self.key_to_mongo_id:
+        self._refresh_loaded_key_index()
+        for key in list(self.key_to_mongo_id):
             yield key
 
     def __len__(self):
+        self._refresh_loaded_key_index()
         return len(self.key_to_mongo_id)
 
+    def _refresh_loaded_key_index(self):
+
+        if self._key_index_loaded and time.time() - self._key_index_loaded_at <= self.KEY_INDEX_TTL:
+
+            self.refresh_key_index()
+
+        else:
+
+            self._load_key_index()
+
     def set_source_collection(self, collection):
 
         self.source_collection = collection
@@ -139,6 +331,8 @@ class NoodleWriteableCollection(MongoCollection):
         self._inserted_document_count = 0
         self._updated_document_count = 0
         self._deleted_document_count = 0
+        self._write_errors = []
+        self._counter_lock = threading.Lock()
 
         super(NoodleWriteableCollection, self).__init__(noodle_client, key=key, filter=filter)
 
@@ -170,6 +364,10 @@ class NoodleWriteableCollection(MongoCollection):
 
         return self._unchanged_document_count
 
+    def write_errors(self):
+
+        return self._write_errors
+
     def _docs_equal(self, source_document, destination_document):
 
         return source_document == destination_document
@@ -187,7 +385,30 @@ class NoodleProductionCollection(NoodleWriteableCollection):
     Also managed queue insertions for SOLR indexing.
     """
 
-    def __init__(self, noodle_client, key="nice_key", queue_manager=None, dryrun=None, filter=None):
+    # Canonical hash of the payload, used to detect changes without
+    # transferring the payload itself.
+    PAYLOAD_HASH_FIELD = "payload_hash"
+
+    # Largest combined BSON size of the documents sent by one insert() call,
+    # well under MongoDB's 48MB message limit.
+    INSERT_MAX_BYTES = 8 * 1024 * 1024
+
+    def __init__(self, noodle_client, key="nice_key", queue_manager=None, dryrun=None, filter=None,
+                 write_batch_size=1000, ordered_writes=False, pipeline_workers=None, pipeline_queue_size=4):
+
+        self.write_batch_size = write_batch_size
+        self.ordered_writes = ordered_writes
+
+        # (fetch, compare, write) thread counts; None runs update() serially
+        if pipeline_workers is not None:
+
+            if len(pipeline_workers) != 3 or not all(isinstance(n, int) and n > 0 for n in pipeline_workers):
+
+                raise ValueError("pipeline_workers must be three positive (fetch, compare, write) thread counts, "
+                                 "got {0!r}".format(pipeline_workers))
+
+        self.pipeline_workers = pipeline_workers
+        self.pipeline_queue_size = pipeline_queue_size
 
         self.key_service = NoodleKeyService(
             source_client=None,
@@ -199,40 +420,151 @@ class NoodleProductionCollection(NoodleWriteableCollection):
         super(NoodleProductionCollection, self).__init__(noodle_client, key=key, dryrun=dryrun, filter=filter)
 
     def insert(self, keys_to_insert):
+        """
+        Streams new destination documents to the database in chunks of at
+        most write_batch_size documents and INSERT_MAX_BYTES bytes, queueing
+        each chunk for indexing once it is written, so memory use does not
+        grow with the number of keys.
+        """
 
-        docs_to_insert = []
+        pending_keys = []
+        pending = []
+        pending_bytes = 0
 
-        for key in keys_to_insert:
+        for key, document in self._new_destination_documents(keys_to_insert):
 
-            source_document = self.source_collection[key]
+            size = bson_size(document)
 
-            new_destination_document = self._create_destination_document(
-                source_document["synkey"],
-                source_document['nice_key'],
-                source_document
-            )
+            if pending and (len(pending) >= self.write_batch_size or pending_bytes + size > self.INSERT_MAX_BYTES):
 
-            docs_to_insert.append(new_destination_document)
+                self._flush_inserts(pending_keys, pending)
+                pending_keys = []
+                pending = []
+                pending_bytes = 0
 
-        if not self.dryrun:
+            pending_keys.append(key)
+            pending.append(document)
+            pending_bytes += size
+
+        if pending:
+
+            self._flush_inserts(pending_keys, pending)
+
+    def _new_destination_documents(self, keys_to_insert):
+
+        for chunk in _chunks(keys_to_insert, self.GET_MANY_CHUNK_SIZE):
+
+            source_documents = self.source_collection._get_many_by_key(chunk)
+
+            for key in chunk:
 
-            self.mongo.insert(docs_to_insert)
-            self._inserted_document_count += len(docs_to_insert)
-            self.queue_manager.queue_insert(keys_to_insert)
+                source_document = source_documents[key]
+
+                yield key, self._create_destination_document(
+                    source_document["synkey"],
+                    source_document['nice_key'],
+                    source_document
+                )
+
+    def _flush_inserts(self, keys, documents):
+
+        if self.dryrun:
+
+            return
+
+        inserted_ids = self.mongo.insert(documents)
+        self._inserted_document_count += len(documents)
+
+        if self._key_index_loaded:
+
+            for document, mongo_id in zip(documents, inserted_ids or []):
+
+                self.key_to_mongo_id[document[self.key]] = mongo_id
+
+        self.queue_manager.queue_insert(keys)
 
     def update(self, keys_to_update):
+        """
+        Replaces the destination documents whose payload differs from the
+        source. Each GET_MANY_CHUNK_SIZE chunk of keys is fetched from both
+        collections, compared and turned into replacement documents, which
+        are written write_batch_size at a time.
+
+        With pipeline_workers set, fetching, comparing and writing run as
+        separate thread stages joined by queues of pipeline_queue_size
+        items, so Mongo round trips overlap the comparison work.
+        """
+
+        if self.pipeline_workers:
+
+            self._update_pipelined(keys_to_update)
+
+        else:
 
-        for key in keys_to_update:
+            pending_updates = []
 
-            source_document = self.source_collection[key]
-            destination_document = self[key]
+            for chunk in _chunks(keys_to_update, self.GET_MANY_CHUNK_SIZE):
+
+                pending_updates.extend(self._compare_update_chunk(self._fetch_update_chunk(chunk)))
+
+                while len(pending_updates) >= self.write_batch_size:
+
+                    self._flush_updates(pending_updates[:self.write_batch_size])
+                    pending_updates = pending_updates[self.write_batch_size:]
+
+            self._flush_updates(pending_updates)
+
+        if not self.dryrun:
+
+            self.queue_manager.queue_update(keys_to_update)
+
+    def _fetch_update_chunk(self, chunk):
+
+        source_documents = self.source_collection._get_many_by_key(chunk)
+        destination_documents = self._get_many_by_key(chunk, fields={"nice_key": 1, self.PAYLOAD_HASH_FIELD: 1})
+
+        # Documents written before payload hashes existed need their
+        # payload for a full compare.
+        legacy_keys = [k for k in chunk if self.PAYLOAD_HASH_FIELD not in destination_documents[k]]
+
+        if legacy_keys:
+
+            destination_documents.update(self._get_many_by_key(legacy_keys))
+
+        return chunk, source_documents, destination_documents
+
+    def _compare_update_chunk(self, fetched):
+        """
+        Returns the writes for a fetched chunk: replacement documents, plus
+        (match, update) pairs storing the payload hash of unchanged legacy
+        documents. Nothing is returned in dryrun mode.
+        """
+
+        chunk, source_documents, destination_documents = fetched
+
+        updated_documents = []
+        unchanged = 0
+
+        for key in chunk:
+
+            source_document = source_documents[key]
+            destination_document = destination_documents[key]
 
             # do dictionary compare to avoid i/o costs updates
             source_document.pop("_id", None)
 
             if self._docs_equal(source_document, destination_document):
 
-                self._unchanged_document_count += 1
+                unchanged += 1
+
+                if self.PAYLOAD_HASH_FIELD not in destination_document and not self.dryrun:
+
+                    # Store the missing hash so later runs skip the payload.
+                    updated_documents.append((
+                        {"_id": destination_document["_id"]},
+                        {"$set": {self.PAYLOAD_HASH_FIELD: self._payload_hash(source_document)}},
+                    ))
+
                 continue
 
             updated_document = self._create_destination_document(
@@ -245,17 +577,218 @@ class NoodleProductionCollection(NoodleWriteableCollection):
 
                 updated_document["_id"] = ObjectId(destination_document["_id"])
 
-                self.mongo.save(updated_document)
-                self._updated_document_count += 1
+                updated_documents.append(updated_document)
 
-        if not self.dryrun:
+        with self._counter_lock:
 
-            self.queue_manager.queue_update(keys_to_update)
+            self._unchanged_document_count += unchanged
+
+        return updated_documents
+
+    def _update_pipelined(self, keys_to_update):
+
+        fetch_workers, compare_workers, write_workers = self.pipeline_workers
+
+        chunks = Queue(self.pipeline_queue_size)
+        fetched = Queue(self.pipeline_queue_size)
+        compared = Queue(self.pipeline_queue_size)
+        errors = []
+
+        def passing(function):
+
+            def handler():
+
+                return function, None
+
+            return handler
+
+        def batching():
+
+            pending = []
+
+            def handle(documents):
+
+                pending.extend(documents)
+
+                while len(pending) >= self.write_batch_size:
+
+                    self._flush_updates(pending[:self.write_batch_size])
+                    del pending[:self.write_batch_size]
+
+            def finish():
+
+                self._flush_updates(pending)
+
+            return handle, finish
+
+        threads = (
+            self._start_pipeline_stage(passing(self._fetch_update_chunk), chunks, fetched,
+                                       fetch_workers, compare_workers, errors) +
+            self._start_pipeline_stage(passing(self._compare_update_chunk), fetched, compared,
+                                       compare_workers, write_workers, errors) +
+            self._start_pipeline_stage(batching, compared, None, write_workers, 0, errors)
+        )
+
+        try:
+
+            for chunk in _chunks(keys_to_update, self.GET_MANY_CHUNK_SIZE):
+
+                if errors:
+
+                    break
+
+                chunks.put(chunk)
+
+        finally:
+
+            for _ in range(fetch_workers):
+
+                chunks.put(_STOP)
+
+        for thread in threads:
+
+            thread.join()
+
+        if errors:
+
+            exc_type, exc_value, exc_traceback = errors[0]
+
+            raise exc_type, exc_value, exc_traceback
+
+    @staticmethod
+    def _start_pipeline_stage(handler_factory, inbox, outbox, workers, next_workers, errors):
+        """
+        Starts workers threads that pass each inbox item through a handler
+        from handler_factory() and put its result in outbox. The last worker
+        to stop sends next_workers stop markers on. After an error, items
+        are drained without being handled so upstream stages never block.
+        """
+
+        remaining = [workers]
+        lock = threading.Lock()
+
+        def work():
+
+            handle, finish = handler_factory()
+
+            try:
+
+                while True:
+
+                    item = inbox.get()
+
+                    if item is _STOP:
+
+                        break
+
+                    if errors:
+
+                        continue
+
+                    try:
+
+                        result = handle(item)
+
+                    except Exception:
+
+                        errors.append(sys.exc_info())
+                        continue
+
+                    if outbox is not None:
+
+                        outbox.put(result)
+
+                if finish and not errors:
+
+                    try:
+
+                        finish()
+
+                    except Exception:
+
+                        errors.append(sys.exc_info())
+
+            finally:
+
+                with lock:
+
+                    remaining[0] -= 1
+                    last = not remaining[0]
+
+                if last and outbox is not None:
+
+                    for _ in range(next_workers):
+
+                        outbox.put(_STOP)
+
+        threads = [threading.Thread(target=work) for _ in range(workers)]
+
+        for thread in threads:
+
+            thread.daemon = True
+            thread.start()
+
+        return threads
+
+    def _flush_updates(self, documents):
+        """
+        Writes a batch of replacement documents in one bulk operation. Failed
+        documents are recorded in write_errors() without aborting the batch
+        (unless ordered_writes is set, in which case the server stops at the
+        first failure). Payload hash backfills in the batch are applied with
+        one bulk update and are not counted as updates.
+        """
+
+        backfills = [d for d in documents if isinstance(d, tuple)]
+
+        if backfills:
+
+            # A failed backfill only means the payload is compared in full
+            # again next time.
+            self.mongo.bulk_update(backfills, ordered=False)
+            documents = [d for d in documents if not isinstance(d, tuple)]
+
+        if not documents:
+
+            return
+
+        result = self.mongo.bulk_replace(documents, ordered=self.ordered_writes)
+
+        with self._counter_lock:
+
+            self._updated_document_count += result.get("nMatched") or 0
+
+            for error in result.get("writeErrors") or []:
+
+                document = documents[error["index"]]
+
+                print "Failed to update {0} ({1}): {2}".format(
+                    document.get(self.key), document["_id"], error.get("errmsg"))
+
+                self._write_errors.append(error)
 
     def _docs_equal(self, source_document, destination_document):
 
-        return source_document.get('nice_key') == destination_document.get('nice_key') and \
-            source_document == destination_document.get("payload")
+        if source_document.get('nice_key') != destination_document.get('nice_key'):
+
+            return False
+
+        if self.PAYLOAD_HASH_FIELD in destination_document:
+
+            return self._payload_hash(source_document) == destination_document[self.PAYLOAD_HASH_FIELD]
+
+        return source_document == destination_document.get("payload")
+
+    @staticmethod
+    def _payload_hash(payload):
+        """
+        Returns a sha1 of the payload's BSON encoding with keys sorted at every
+        level, so equal payloads hash equally regardless of key order while
+        values of different BSON types (an ObjectId and its hex string, a
+        datetime and its isoformat) still hash apart.
+        """
+
+        return hashlib.sha1(BSON.encode(_sorted_son(payload))).hexdigest()
 
     def delete(self, keys_to_delete):
 
@@ -264,17 +797,17 @@ class NoodleProductionCollection(NoodleWriteableCollection):
             object_ids = []
             nice_keys = []
 
-            for key in keys_to_delete:
-
-                document = self.get(key, {})
-
-                if document:
+            for document in self.get_many(keys_to_delete, fields={"nice_key": 1}):
 
-                    object_ids.append(document["_id"])
-                    nice_keys.append(document["nice_key"])
+                object_ids.append(document["_id"])
+                nice_keys.append(document["nice_key"])
 
             self.mongo.remove({"_id": {"$in": object_ids}}, multi=True)
             self._deleted_document_count += len(object_ids)
+
+            for key in keys_to_delete:
+
+                self.key_to_mongo_id.pop(key, None)
             self.queue_manager.queue_delete(nice_keys)
 
     def _create_destination_document(self, synkey_f, nice_key, document):
@@ -293,6 +826,7 @@ class NoodleProductionCollection(NoodleWriteableCollection):
                 'pnice_key': None,
                 "last_update": datetime.now().isoformat(),
                 "payload": document,
+                self.PAYLOAD_HASH_FIELD: self._payload_hash(document),
                 "soft_delete": False,
             }
 
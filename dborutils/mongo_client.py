@@ -1,18 +1,282 @@
-from pymongo import MongoClient
+import os
+import threading
+import time
+from pymongo import ASCENDING, MongoClient
+from pymongo.errors import BulkWriteError, OperationFailure
+from instrumentation import MongoStats, bson_size, instrumented
 
 
-class NoodleMongoClient(MongoClient):
+class MetadataCache(object):
+    """
+    Database and collection names of one MongoClient, each list read from
+    the server at most once every ttl seconds, plus the contents of each
+    database's categories collection, re-read every category_ttl seconds,
+    and each collection's index catalog, re-read every ttl seconds.
+    A name that is not found forces a re-read, so newly created databases,
+    collections and categories are seen.
+    """
+
+    def __init__(self, client, ttl=60, category_ttl=600):
+
+        self._client = client
+        self.ttl = ttl
+        self.category_ttl = category_ttl
+        self._entries = {}
+        self._categories = {}
+        self._indexes = {}
+
+    def _names(self, key, read, refresh=False):
+
+        read_at, names = self._entries.get(key, (None, None))
+
+        if refresh or read_at is None or (self.ttl is not None and time.time() - read_at > self.ttl):
+
+            names = set(read())
+            self._entries[key] = (time.time(), names)
+
+        return names
+
+    def categories(self, database, collection, read):
+        """
+        Category documents of database whose 'collection' is collection,
+        loading the whole categories collection with read() when needed.
+        """
+
+        for refresh in (False, True):
+
+            read_at, by_collection = self._categories.get(database, (None, None))
+
+            if refresh or read_at is None or \
+                    (self.category_ttl is not None and time.time() - read_at > self.category_ttl):
+
+                by_collection = {}
+
+                for category in read():
+
+                    by_collection.setdefault(category.get("collection"), []).append(category)
+
+                self._categories[database] = (time.time(), by_collection)
+
+            if collection in by_collection:
+
+                break
+
+        return [dict(category) for category in by_collection.get(collection, [])]
+
+    def indexes(self, database, collection, read):
+        """
+        Index catalog of database.collection as returned by
+        index_information(). The cached dict itself is returned so that
+        indexes created through it can be recorded without a re-read.
+        """
+
+        read_at, catalog = self._indexes.get((database, collection), (None, None))
+
+        if read_at is None or (self.ttl is not None and time.time() - read_at > self.ttl):
+
+            catalog = dict(read())
+            self._indexes[(database, collection)] = (time.time(), catalog)
+
+        return catalog
+
+    def invalidate_categories(self):
+
+        self._categories.clear()
+
+    def has_database(self, database):
+
+        return database in self._names(None, self._client.database_names) or \
+            database in self._names(None, self._client.database_names, refresh=True)
+
+    def has_collection(self, database, collection):
+
+        read = self._client[database].collection_names
+
+        return collection in self._names(database, read) or \
+            collection in self._names(database, read, refresh=True)
+
+    def invalidate(self):
+
+        self._entries.clear()
+        self._categories.clear()
+        self._indexes.clear()
+
+
+class MongoClientRegistry(object):
+    """
+    Process-wide registry sharing one pooled MongoClient per host and port,
+    where host is the mongodb:// URI (credentials included) produced by
+    NoodleMongoClient.parse_argstring/parse_db_argstring.
+
+    Clients are never shared across a fork. A client older than
+    max_lifetime seconds is replaced the next time it is asked for. Only
+    views created from then on use the new client: existing views keep the
+    old one, and its pool, until they are garbage collected, so recycle
+    long-lived views too when relying on max_lifetime.
+    """
+
+    max_pool_size = 100
+    max_lifetime = None
+    metadata_ttl = 60
+    category_ttl = 600
+
+    _clients = {}
+    _metadata = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, max_pool_size=None, max_lifetime=None, metadata_ttl=None, category_ttl=None):
+        """
+        Set the pool size and lifetime used for clients created from now on,
+        and the TTLs of their metadata caches. Options left as None keep
+        their current value; a max_lifetime of 0 turns recycling off.
+        """
+
+        if max_pool_size is not None:
+
+            cls.max_pool_size = max_pool_size
+
+        if metadata_ttl is not None:
+
+            cls.metadata_ttl = metadata_ttl
+
+        if category_ttl is not None:
+
+            cls.category_ttl = category_ttl
+
+        if max_lifetime is not None:
+
+            cls.max_lifetime = max_lifetime
+
+    @classmethod
+    def get(cls, host, port=27017):
+
+        key = (os.getpid(), host, port)
+
+        with cls._lock:
+
+            created_at, client = cls._clients.get(key, (None, None))
+
+            if client is not None and cls.max_lifetime and time.time() - created_at > cls.max_lifetime:
+
+                # Not closed: views still holding it would just reconnect
+                # and open a second pool.
+                cls._metadata.pop(id(client), None)
+                client = None
+
+            if client is None:
+
+                client = MongoClient(host, port=port, max_pool_size=cls.max_pool_size)
+                cls._clients[key] = (time.time(), client)
+
+            return client
+
+    @classmethod
+    def metadata(cls, client):
+        """The MetadataCache shared by every view of client."""
+
+        with cls._lock:
+
+            if id(client) not in cls._metadata:
+
+                cls._metadata[id(client)] = MetadataCache(client, ttl=cls.metadata_ttl,
+                                                          category_ttl=cls.category_ttl)
+
+            return cls._metadata[id(client)]
+
+    @classmethod
+    def close_all(cls):
+
+        with cls._lock:
+
+            for created_at, client in cls._clients.values():
+
+                client.close()
+
+            cls._clients.clear()
+            cls._metadata.clear()
+
+
+def _argument(args, kwargs, index, name):
+
+    return args[index] if len(args) > index else kwargs.get(name)
+
+
+def _measure_written(args, kwargs, result):
+
+    documents = _argument(args, kwargs, 0, "documents") or _argument(args, kwargs, 0, "document")
+
+    if isinstance(documents, dict):
+
+        documents = [documents]
+
+    if not isinstance(documents, (list, tuple)):
+
+        return 0, 0
+
+    return len(documents), sum(bson_size(document) for document in documents)
+
+
+def _measure_found(args, kwargs, result):
+
+    return (1, bson_size(result)) if result else (0, 0)
+
+
+def _measure_affected(args, kwargs, result):
+
+    affected = result.get("n", 0) if isinstance(result, dict) else 0
+
+    return affected, bson_size(_argument(args, kwargs, 1, "set_obj") or {})
+
+
+def _measure_removed(args, kwargs, result):
+
+    removed = result.get("n", 0) if isinstance(result, dict) else 0
+
+    return removed, bson_size(_argument(args, kwargs, 0, "match_obj") or {})
+
+
+def _measure_bulk(args, kwargs, result):
+
+    operations = _argument(args, kwargs, 0, "documents") or _argument(args, kwargs, 0, "updates")
+    size = 0
+
+    if isinstance(operations, list):
+
+        size = sum(bson_size(op[1] if isinstance(op, tuple) else op) for op in operations)
+
+    return (result.get("nMatched") or 0) + (result.get("nInserted") or 0), size
+
+
+class NoodleMongoClient(object):
     """A MongoClient convenience class that exposes default collection
     methods directly on the class.
+
+    Instances are thin views over the MongoClient that MongoClientRegistry
+    shares between every NoodleMongoClient for the same host and port; any
+    other MongoClient attribute is looked up on that shared client.
+
+    The database and collection are checked for existence against the
+    shared client's MetadataCache; pass validate=False to skip the checks.
+
+    Calling instrument() records the latency, documents and bytes of every
+    collection operation in a MongoStats.
     """
 
-    def __init__(self, host, database, collection=None, port=27017, use_nice_key=True, create_collection=False):
+    _stats = None
+
+    # Documents fetched per round trip by scan()
+    SCAN_BATCH_SIZE = 1000
+
+    def __init__(self, host, database, collection=None, port=27017, use_nice_key=True, create_collection=False,
+                 validate=True):
 
-        super(NoodleMongoClient, self).__init__(host, port=port)
+        self._client = MongoClientRegistry.get(host, port=port)
+        self._metadata = MongoClientRegistry.metadata(self._client)
 
         self.use_nice_key = use_nice_key
 
-        if database in self.database_names():
+        if not validate or self._metadata.has_database(database):
 
             self._database = self[database]
 
@@ -21,13 +285,13 @@ class NoodleMongoClient(MongoClient):
             raise KeyError("Could not find database '{1}' on host '{0}'".format(self.host, database))
 
         if collection:
-            if create_collection:
+            if create_collection or not validate:
 
                 self._collection = self._database[collection]
 
             else:
 
-                if collection in self._database.collection_names():
+                if self._metadata.has_collection(database, collection):
 
                     self._collection = self._database[collection]
 
@@ -36,6 +300,31 @@ class NoodleMongoClient(MongoClient):
                     raise KeyError("Could not find collection '{1}' in database '{0}'".format(
                         self._database, collection))
 
+    def __getattr__(self, name):
+
+        if name in ("_client", "_metadata"):
+
+            raise AttributeError(name)
+
+        return getattr(self._client, name)
+
+    def __getitem__(self, name):
+
+        return self._client[name]
+
+    def client(self):
+
+        return self._client
+
+    def close(self):
+        """
+        Does nothing: the MongoClient is shared with every other view of the
+        same host, so only MongoClientRegistry.close_all() closes it.
+        """
+
+    # MongoClient's alias for close()
+    disconnect = close
+
     def database(self):
 
         return self._database
@@ -44,14 +333,145 @@ class NoodleMongoClient(MongoClient):
 
         return self._collection
 
-    def find(self, filter, fields=None):
+    def instrument(self, stats=None):
+        """Start recording operations into stats (a new MongoStats by default) and return it."""
+
+        self._stats = stats or MongoStats()
+
+        return self._stats
+
+    def stats(self):
+
+        return self._stats
+
+    @instrumented("find")
+    def find(self, filter, fields=None, **kwargs):
+
+        return self._collection.find(filter, fields, **kwargs)
+
+    def count(self, filter=None):
+
+        # Counted through find() so instrumented clients record it.
+        return self.find(filter or {}, {"_id": 1}).count()
+
+    def scan(self, filter=None, fields=None, batch_size=None, sort=None, hint=None, no_timeout=False,
+             id_range=None, raw_batches=False):
+        """
+        Streams the documents matching filter, fetching batch_size of them
+        per round trip. sort is a field name or a list of (field, direction)
+        pairs and hint an index spec. no_timeout stops the server from
+        reaping the cursor during long runs; the cursor is closed when the
+        scan ends or is abandoned. id_range is a (lower, upper) pair from
+        id_ranges() that limits the scan to one shard. With raw_batches,
+        lists of up to batch_size documents are yielded instead of single
+        documents.
+        """
+
+        batch_size = batch_size or self.SCAN_BATCH_SIZE
+        filter = filter or {}
+
+        if id_range is not None:
+
+            filter = self._id_range_filter(filter, *id_range)
+
+        cursor = self.find(filter, fields, timeout=not no_timeout).batch_size(batch_size)
+
+        if sort:
+
+            cursor = cursor.sort(sort) if isinstance(sort, list) else cursor.sort(sort, ASCENDING)
+
+        if hint:
+
+            cursor = cursor.hint(hint)
+
+        try:
+
+            if not raw_batches:
+
+                for document in cursor:
+
+                    yield document
+
+                return
+
+            batch = []
 
-        return self._collection.find(filter, fields)
+            for document in cursor:
 
+                batch.append(document)
+
+                if len(batch) >= batch_size:
+
+                    yield batch
+                    batch = []
+
+            if batch:
+
+                yield batch
+
+        finally:
+
+            cursor.close()
+
+    def scan_ranges(self, filter=None, count=4, **options):
+        """
+        Splits a scan into up to count scan() generators over contiguous _id
+        ranges, to be consumed by separate workers. Workers in other
+        processes should call scan() with id_range themselves.
+        """
+
+        return [self.scan(filter, id_range=id_range, **options) for id_range in self.id_ranges(filter or {}, count)]
+
+    @staticmethod
+    def _id_range_filter(filter, lower, upper):
+
+        id_range = {}
+
+        if lower is not None:
+
+            id_range["$gte"] = lower
+
+        if upper is not None:
+
+            id_range["$lt"] = upper
+
+        if not id_range:
+
+            return filter
+
+        match = {"_id": id_range}
+
+        return {"$and": [filter, match]} if filter else match
+
+    @instrumented("find_one", _measure_found)
     def find_one(self, filter, fields=None):
 
         return self._collection.find_one(filter, fields)
 
+    def id_ranges(self, filter, count):
+        """
+        Split the documents matching filter into up to count contiguous _id
+        ranges of roughly equal size. Returns (lower, upper) pairs, lower
+        inclusive and upper exclusive, with None for an open end.
+        """
+
+        total = self.count(filter)
+        step = total // count
+
+        bounds = []
+
+        if step:
+
+            for i in range(1, count):
+
+                for doc in self.find(filter, {"_id": 1}).sort("_id", 1).skip(i * step).limit(1):
+
+                    bounds.append(doc["_id"])
+
+        edges = [None] + bounds + [None]
+
+        return zip(edges[:-1], edges[1:])
+
     def get_category_code(self):
 
         result = self.get_category().get("code")
@@ -64,9 +484,10 @@ class NoodleMongoClient(MongoClient):
 
     def get_category(self):
 
-        category = self.category_collection().find({"collection": self._collection.name})
+        category = self._metadata.categories(self._database.name, self._collection.name,
+                                             lambda: self.category_collection().find())
 
-        cnt = category.count()
+        cnt = len(category)
 
         if cnt == 0:
 
@@ -78,12 +499,17 @@ class NoodleMongoClient(MongoClient):
 
         return category[0]
 
+    def invalidate_category_cache(self):
+        """Forget the cached categories so the next lookup reloads them."""
+
+        self._metadata.invalidate_categories()
+
     def category_collection(self):
 
         result = None
         collection = 'categories'
 
-        if collection in self._database.collection_names():
+        if self._metadata.has_collection(self._database.name, collection):
 
             result = self._database[collection]
 
@@ -93,74 +519,203 @@ class NoodleMongoClient(MongoClient):
 
         return result
 
+    @instrumented("insert", _measure_written)
     def insert(self, documents):
 
         return self._collection.insert(documents)
 
+    @instrumented("update", _measure_affected)
     def update(self, match_obj, set_obj, upsert=False, multi=False):
 
-        self._collection.update(match_obj, set_obj, upsert=upsert, multi=multi)
+        return self._collection.update(match_obj, set_obj, upsert=upsert, multi=multi)
 
+    @instrumented("remove", _measure_removed)
     def remove(self, match_obj, multi=False):
 
-        self._collection.remove(match_obj, multi=multi)
+        return self._collection.remove(match_obj, multi=multi)
+
+    @instrumented("bulk_replace", _measure_bulk)
+    def bulk_replace(self, documents, ordered=True):
+        """
+        Replaces each document, matched on its _id, in one bulk operation.
+        Per-document failures are returned in the result's writeErrors
+        instead of being raised.
+        """
+
+        return self._execute_bulk(
+            [({"_id": document["_id"]}, document) for document in documents],
+            lambda bulk, match_obj, document: bulk.find(match_obj).replace_one(document),
+            ordered
+        )
+
+    @instrumented("bulk_update", _measure_bulk)
+    def bulk_update(self, updates, ordered=True):
+        """
+        Applies (match_obj, update_obj) pairs as single-document updates in
+        one bulk operation. Per-document failures are returned in the
+        result's writeErrors instead of being raised.
+        """
+
+        return self._execute_bulk(
+            list(updates),
+            lambda bulk, match_obj, update_obj: bulk.find(match_obj).update_one(update_obj),
+            ordered
+        )
+
+    def _execute_bulk(self, operations, add_operation, ordered):
+
+        if not operations:
+
+            return {"nMatched": 0, "nModified": 0, "writeErrors": []}
+
+        if ordered:
+
+            bulk = self._collection.initialize_ordered_bulk_op()
+
+        else:
+
+            bulk = self._collection.initialize_unordered_bulk_op()
+
+        for match_obj, operation in operations:
+
+            add_operation(bulk, match_obj, operation)
+
+        try:
+
+            result = bulk.execute()
+
+        except BulkWriteError as e:
+
+            result = e.details
+
+        return result
 
     def purge_soft_deleted(self):
 
         return self._collection.remove({"soft_delete": True})
 
+    @instrumented("save", _measure_written)
     def save(self, document):
 
         return self._collection.save(document)
 
     def ensure_index(self, field, sparse=True, unique=False, background=True):
 
-        result = self._collection.ensure_index(field, sparse=sparse, unique=unique, background=background)
+        return self.ensure_indexes([{"key": field, "sparse": sparse, "unique": unique, "background": background}])[0]
 
-        if type(result) == dict:
-            if result.get("err"):
-                if result["ok"] == 1:
-                    if result.code == 11000:
-                        raise KeyError(result.err)
-                    else:
-                        raise KeyError("{0}: {1}.".format(result["code"], result["err"]))
-                else:
-                    raise Exception("Ensure_index: {0}.".format(result))
+    @instrumented("ensure_indexes")
+    def ensure_indexes(self, specs):
+        """
+        Creates whichever indexes in specs are missing and verifies all of
+        them against one cached snapshot of the collection's index catalog.
+
+        Each spec is a dict with 'key', either a field name or a list of
+        (field, direction) pairs for a compound index, and optional 'unique',
+        'sparse' and 'background' flags (sparse and background default to
+        True). Returns the name of each index created, or None where one on
+        the same key already existed. A unique spec whose key already has a
+        non-unique index raises KeyError, as the server would refuse to
+        create it with conflicting options.
+        """
+
+        catalog = self._index_catalog()
+
+        result = []
+
+        for spec in specs:
+
+            key = self._index_key(spec["key"])
+            unique = spec.get("unique", False)
+            sparse = spec.get("sparse", True)
+
+            created = None
+            existing = self._find_index(catalog, key)
+
+            if existing is not None and unique and not existing.get('unique'):
+
+                raise KeyError("Index on '{0}' on '{1} {2}.{3}' exists but is not unique.".format(
+                    ", ".join(f for f, _ in key), self.host, self._database.name, self._collection.name))
+
+            if existing is None:
+
+                try:
+
+                    created = self._collection.create_index(key, unique=unique, sparse=sparse,
+                                                            background=spec.get("background", True))
+
+                except OperationFailure as e:
+
+                    raise KeyError("{0}: {1}.".format(e.code, e))
+
+                catalog[created] = {"key": key, "unique": unique, "sparse": sparse}
+
+            self._verify_index(key, unique, catalog=catalog)
 
-        self._verify_index(field, unique)
+            result.append(created)
 
         return result
 
-    def _verify_index(self, field, unique=False):
+    def _index_catalog(self):
 
+        return self._metadata.indexes(self._database.name, self._collection.name,
+                                      self._collection.index_information)
+
+    @staticmethod
+    def _index_key(key):
+
+        if isinstance(key, basestring):
+
+            return [(key, 1)]
+
+        return [(field, int(direction) if isinstance(direction, float) else direction) for field, direction in key]
+
+    def _find_index(self, catalog, key):
         """
-            Verifies that an index exists for the specified field, checking for
-            optional uniqueness as well.
+        Returns the catalog entry of an index on key, preferring a unique
+        one. A single-field index matches whatever its direction, since it
+        can be walked either way.
         """
 
-        result = False
-        for _, v in self._collection.index_information().iteritems():
+        matches = []
 
-            index_key = v.get('key') or []
+        for name, info in catalog.iteritems():
 
-            if len(index_key) == 1:
+            existing = self._index_key(info.get('key') or [])
 
-                if index_key[0][0] == field:
+            if existing == key or (len(existing) == len(key) == 1 and existing[0][0] == key[0][0]):
 
-                    if unique and not v.get('unique'):
+                matches.append(info)
 
-                        if not self.use_nice_key:
-                            raise KeyError("No unique index available for '{0}' on '{1} {2}.{3}'".format(
-                                field, self.host, self._database.name, self._collection.name))
+        for info in matches:
 
-                    result = True
+            if info.get('unique'):
 
-                    break
+                return info
 
-        if not result:
+        return matches[0] if matches else None
+
+    def _verify_index(self, field, unique=False, catalog=None):
+
+        """
+            Verifies that an index exists for the specified field (or compound
+            key), checking for optional uniqueness as well.
+        """
+
+        key = self._index_key(field)
+        description = ", ".join(f for f, _ in key)
+
+        info = self._find_index(self._index_catalog() if catalog is None else catalog, key)
+
+        if info is None:
 
             raise KeyError("Could not find {0}index for '{1}' on '{2} {3}.{4}'.".format(
-                "unique " if unique else "", field, self.host, self._database.name, self._collection.name))
+                "unique " if unique else "", description, self.host, self._database.name, self._collection.name))
+
+        if unique and not info.get('unique'):
+
+            if not self.use_nice_key:
+                raise KeyError("No unique index available for '{0}' on '{1} {2}.{3}'".format(
+                    description, self.host, self._database.name, self._collection.name))
 
     def index_information(self):
 
@@ -175,7 +730,7 @@ class NoodleMongoClient(MongoClient):
         return "{0}:{1}:{2}:{3}".format(self.host, self.port, self._database.name, self._collection.name)
 
     @classmethod
-    def create_from_mongo_spec(cls, mongo_spec, use_nice_key=True, create_collection=False):
+    def create_from_mongo_spec(cls, mongo_spec, use_nice_key=True, create_collection=False, validate=True):
         """
         Returns an instance of NoodleMongoClient based on colon-delimited
         host:database:collection spec
@@ -191,11 +746,12 @@ class NoodleMongoClient(MongoClient):
                                        ms[3],
                                        port=int(ms[1]),
                                        use_nice_key=use_nice_key,
-                                       create_collection=create_collection)
+                                       create_collection=create_collection,
+                                       validate=validate)
         return result
 
     @classmethod
-    def create_from_db_spec(cls, db_spec):
+    def create_from_db_spec(cls, db_spec, validate=True):
         """
         Returns an instance of NoodleMongoClient based on colon-delimited
         host:port:database spec
@@ -206,7 +762,7 @@ class NoodleMongoClient(MongoClient):
 
         if spec:
             ms = list(spec)
-            result = NoodleMongoClient(ms[0], ms[2], collection=None, port=int(ms[1]))
+            result = NoodleMongoClient(ms[0], ms[2], collection=None, port=int(ms[1]), validate=validate)
 
         return result
 
@@ -1,6 +1,48 @@
 # -*- coding: utf-8 -*-
 
 import re
+import threading
+from collections import OrderedDict, deque
+from multiprocessing import Pool
+
+# Accented characters and their English equivalent.
+ACCENT_FOLDS = {
+    'À': 'A', 'Á': 'A', 'Â': 'A', 'Ã': 'A', 'Ä': 'A', 'Å': 'A',
+    'à': 'a', 'á': 'a', 'â': 'a', 'ã': 'a', 'ä': 'a', 'å': 'a',
+    'È': 'E', 'É': 'E', 'Ê': 'E', 'Ë': 'E',
+    'è': 'e', 'é': 'e', 'ê': 'e', 'ë': 'e',
+    'ì': 'i', 'í': 'i', 'î': 'i', 'ï': 'i',
+    'ñ': 'n',
+    'Ñ': 'N',
+    'ó': 'o', 'ō': 'o', 'ö': 'o',
+    'Ó': 'O', 'Ō': 'O', 'Ö': 'O',
+    'ù': 'u', 'ú': 'u', 'ü': 'u',
+    'Ù': 'U', 'Ú': 'U', 'Ü': 'U',
+}
+
+# The keys above are UTF-8 byte strings, so they fold UTF-8 encoded str
+# values. Matched against unicode values the same bytes are read as
+# Latin-1 code points; the unicode table reproduces that so results stay
+# identical to the original chain of re.sub calls for both types.
+_FOLDS = {
+    str: ACCENT_FOLDS,
+    unicode: {k.decode('latin-1'): unicode(v) for k, v in ACCENT_FOLDS.iteritems()},
+}
+
+_ACCENT_PATTERN = re.compile('|'.join(re.escape(k) for k in sorted(ACCENT_FOLDS)))
+
+# Underscores and any other non-word run collapse to a single dash. Like the
+# original, \W is ASCII-only: other non-ASCII characters become dashes.
+_SEPARATOR_PATTERN = re.compile(r'[\W_]+')
+
+# Distinct values kept by the landing_page_slugify() LRU cache
+SLUG_CACHE_SIZE = 10000
+
+# Documents whose facet values are slugified together by build_facets()
+FACET_BATCH_SIZE = 1000
+
+_slug_cache = OrderedDict()
+_slug_cache_lock = threading.Lock()
 
 
 def get_slug_label_facet_value(value):
@@ -17,29 +59,177 @@ def landing_page_slugify(value):
     Custom slugify function for landing page urls, which allows us to create
     seo-friendly and human readable urls. It is vital that this stays
     consistent with the landing page slugifier in our Django app.
+
+    Results are memoized in a SLUG_CACHE_SIZE entry LRU cache, since facet
+    values such as states and degree types repeat across documents.
+    """
+    key = (type(value), value)
+
+    with _slug_cache_lock:
+
+        slug = _slug_cache.pop(key, None)
+
+        if slug is not None:
+
+            _slug_cache[key] = slug
+
+            return slug
+
+    slug = _slugify(value)
+    _remember_slugs([(key, slug)])
+
+    return slug
+
+
+def _remember_slugs(slugs):
+
+    with _slug_cache_lock:
+
+        for key, slug in slugs:
+
+            _slug_cache[key] = slug
+
+        while len(_slug_cache) > SLUG_CACHE_SIZE:
+
+            _slug_cache.popitem(last=False)
+
+
+def clear_slug_cache():
+
+    with _slug_cache_lock:
+
+        _slug_cache.clear()
+
+
+def build_facets(documents, fields, batch_size=None, processes=None):
+    """
+    Streams one {field: [slug->>label, ...]} dict per document, in order,
+    for the values of fields. List values give one facet per item; missing
+    and None values are left out. Each distinct value is turned into a
+    facet once per batch of batch_size documents.
+
+    With processes, the distinct values of each batch are handed to a pool
+    of that many workers, each starting from a copy of this process' slug
+    cache and keeping it warm across batches. At most two batches per
+    worker are in flight, so memory stays bounded.
     """
+
+    batch_size = batch_size or FACET_BATCH_SIZE
+    batches = _facet_batches(documents, fields, batch_size)
+
+    if not processes:
+
+        for batch, values in batches:
+
+            for facets in _batch_facets(batch, fields, _facet_values(values)):
+
+                yield facets
+
+        return
+
+    with _slug_cache_lock:
+
+        seed = _slug_cache.items()
+
+    pool = Pool(processes, initializer=_seed_slug_cache, initargs=(seed,))
+    in_flight = deque()
+
+    try:
+
+        for batch, values in batches:
+
+            in_flight.append((batch, pool.apply_async(_facet_values, (values,))))
+
+            while len(in_flight) > 2 * processes:
+
+                batch, result = in_flight.popleft()
+
+                for facets in _batch_facets(batch, fields, result.get()):
+
+                    yield facets
+
+        while in_flight:
+
+            batch, result = in_flight.popleft()
+
+            for facets in _batch_facets(batch, fields, result.get()):
+
+                yield facets
+
+    finally:
+
+        pool.terminate()
+
+
+def _field_values(document, field):
+
+    value = document.get(field)
+
+    if value is None:
+
+        return []
+
+    return value if isinstance(value, (list, tuple)) else [value]
+
+
+def _facet_batches(documents, fields, batch_size):
+    """Yields (batch, values): per-document field values and the batch's distinct values."""
+
+    batch = []
+    distinct = {}
+
+    for document in documents:
+
+        document_values = [_field_values(document, field) for field in fields]
+        batch.append(document_values)
+
+        for values in document_values:
+
+            for value in values:
+
+                distinct[(type(value), value)] = value
+
+        if len(batch) >= batch_size:
+
+            yield batch, distinct.items()
+            batch = []
+            distinct = {}
+
+    if batch:
+
+        yield batch, distinct.items()
+
+
+def _facet_values(values):
+
+    return {key: get_slug_label_facet_value(value) for key, value in values}
+
+
+def _batch_facets(batch, fields, facets_by_value):
+
+    for document_values in batch:
+
+        yield {
+            field: [facets_by_value[(type(value), value)] for value in values]
+            for field, values in zip(fields, document_values) if values
+        }
+
+
+def _seed_slug_cache(items):
+
+    with _slug_cache_lock:
+
+        _slug_cache.clear()
+        _slug_cache.update(items)
+
+
+def _slugify(value):
+
+    folds = _FOLDS[unicode if isinstance(value, unicode) else str]
+
     # Replace special characters with their English equivalent.
-    value = re.sub('À|Á|Â|Ã|Ä|Å', 'A', value)
-    value = re.sub('à|á|â|ã|ä|å', 'a', value)
-    value = re.sub('È|É|Ê|Ë', 'E', value)
-    value = re.sub('è|é|ê|ë', 'e', value)
-    value = re.sub('ì|í|î|ï', 'i', value)
-    value = re.sub('ñ', 'n', value)
-    value = re.sub('Ñ', 'N', value)
-    value = re.sub('ó|ō|ö', 'o', value)
-    value = re.sub('Ó|Ō|Ö', 'O', value)
-    value = re.sub('ù|ú|ü', 'u', value)
-    value = re.sub('Ù|Ú|Ü', 'U', value)
-
-    # Replace underscores with space.
-    value = re.sub('_', ' ', value)
-
-    # Replace non-word values with dash[-]. A word is digit, letter or
-    # underscore.
-    value = re.sub('\W+', '-', value)
-
-    # Replace multiple dashes with single dash
-    value = re.sub('\-{2,}', '-', value)
-
-    # Strip any trailing dashes[-] and lowercase, return that value.
-    return value.strip('-').lower()
+    value = _ACCENT_PATTERN.sub(lambda match: folds[match.group()], value)
+
+    # Replace underscores and non-word values with a single dash[-]. Strip
+    # any trailing dashes[-] and lowercase, return that value.
+    return _SEPARATOR_PATTERN.sub('-', value).strip('-').lower()
@@ -0,0 +1,300 @@
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING
+
+_END = object()
+
+
+class NoodleSyncPlanner(object):
+    """
+    Works out which keys must be inserted into, updated in or deleted from
+    a destination collection to bring it in line with a source collection.
+
+    Both collections are streamed in key order with a key-only projection
+    and merge-joined, so memory use is bounded by batch_size regardless of
+    collection size. The sort is served by the unique index that
+    MongoCollection ensures on nice_key; other keys should be indexed too.
+    """
+
+    def __init__(self, source_collection, destination_collection, batch_size=1000, skip_provider_managed=True):
+
+        self.source_collection = source_collection
+        self.destination_collection = destination_collection
+        self.batch_size = batch_size
+        self.skip_provider_managed = skip_provider_managed
+
+    def _sorted_keys(self, collection):
+
+        documents = collection.mongo.scan(collection.filter, {collection.key: 1, "_id": 0}, batch_size=self.batch_size,
+                                          sort=collection.key, no_timeout=True)
+
+        previous = _END
+
+        for d in documents:
+
+            key = d.get(collection.key)
+
+            if key is not None and key != previous:
+
+                previous = key
+
+                yield key
+
+    def __iter__(self):
+        """
+        Yields (action, keys) tuples where action is 'insert', 'update' or
+        'delete' and keys holds at most batch_size keys.
+        """
+
+        pending = {"insert": [], "update": [], "delete": []}
+        provider_managed = self.destination_collection.provider_managed_keys() if self.skip_provider_managed else ()
+
+        source_keys = self._sorted_keys(self.source_collection)
+        destination_keys = self._sorted_keys(self.destination_collection)
+
+        source_key = next(source_keys, _END)
+        destination_key = next(destination_keys, _END)
+
+        while source_key is not _END or destination_key is not _END:
+
+            if destination_key is _END or (source_key is not _END and source_key < destination_key):
+
+                action, key = "insert", source_key
+                source_key = next(source_keys, _END)
+
+            elif source_key is _END or destination_key < source_key:
+
+                action, key = "delete", destination_key
+                destination_key = next(destination_keys, _END)
+
+            else:
+
+                action, key = "update", source_key
+                source_key = next(source_keys, _END)
+                destination_key = next(destination_keys, _END)
+
+            if action != "insert" and key in provider_managed:
+
+                continue
+
+            pending[action].append(key)
+
+            if len(pending[action]) >= self.batch_size:
+
+                yield action, pending[action]
+                pending[action] = []
+
+        for action in ("insert", "update", "delete"):
+
+            if pending[action]:
+
+                yield action, pending[action]
+
+    def run(self):
+        """
+        Applies the plan to the destination collection. Inserted and deleted
+        keys always lie behind the destination cursor's position in key
+        order, so writing while the scan is open does not disturb it.
+        """
+
+        self.destination_collection.set_source_collection(self.source_collection)
+
+        for action, keys in self:
+
+            getattr(self.destination_collection, action)(keys)
+
+
+class NoodleIncrementalSync(object):
+    """
+    Syncs only the source documents changed since the previous run. Each
+    destination collection keeps a high-water mark of field, the source's
+    last_update timestamp by default or "_id" to pick up new documents
+    only, in the destination database's sync_watermarks collection.
+
+    Changed keys are streamed from the source in field order, in batches
+    of batch_size, and routed to the destination's insert or update. The
+    first run, with no watermark yet, is a full NoodleSyncPlanner sync.
+    Deletions are not seen by incremental runs, so schedule a full sync
+    now and then to remove them. The field should be indexed on the
+    source; call ensure_index() once if it is not.
+    """
+
+    WATERMARK_COLLECTION = "sync_watermarks"
+
+    def __init__(self, source_collection, destination_collection, field="last_update", batch_size=1000,
+                 skip_provider_managed=True):
+
+        self.source_collection = source_collection
+        self.destination_collection = destination_collection
+        self.field = field
+        self.batch_size = batch_size
+        self.skip_provider_managed = skip_provider_managed
+
+    def ensure_index(self):
+        """
+        Indexes field on the source collection, so changed_keys does not scan
+        it. Called explicitly by the owner of the source, since the sync may
+        only have read access to it.
+        """
+
+        if self.field != "_id":
+
+            self.source_collection.mongo.ensure_indexes([{"key": self.field}])
+
+    def _watermarks(self):
+
+        return self.destination_collection.mongo.database()[self.WATERMARK_COLLECTION]
+
+    def _watermark_id(self):
+
+        return "{0}:{1}".format(self.destination_collection.mongo.collection().name, self.field)
+
+    def watermark(self):
+        """The highest field value already synced, or None before the first run."""
+
+        document = self._watermarks().find_one({"_id": self._watermark_id()})
+
+        return document["value"] if document else None
+
+    def set_watermark(self, value):
+
+        self._watermarks().update({"_id": self._watermark_id()},
+                                  {"$set": {"value": value, "updated": datetime.now().isoformat()}},
+                                  upsert=True)
+
+    def reset_watermark(self):
+        """Forget the watermark so the next run is a full sync."""
+
+        self._watermarks().remove({"_id": self._watermark_id()})
+
+    def _match(self, match):
+
+        source_filter = self.source_collection.filter
+
+        return {"$and": [source_filter, match]} if source_filter else match
+
+    def _edge_value(self, match, direction):
+
+        match = dict(match, **{self.field: {"$exists": True}})
+
+        for document in self.source_collection.mongo.find(self._match(match), {self.field: 1}) \
+                .sort(self.field, direction).limit(1):
+
+            return document[self.field]
+
+        return None
+
+    def _initial_watermark(self):
+        """
+        The mark a full sync may resume from: the highest field value, held
+        at the lowest value of a document without a key yet, as in
+        changed_keys.
+        """
+
+        held_at = self._edge_value({self.source_collection.key: None}, ASCENDING)
+
+        if held_at is not None:
+
+            print "Holding the watermark at {0}: documents from there have no {1} yet".format(
+                held_at, self.source_collection.key)
+
+            return held_at
+
+        return self._edge_value({}, DESCENDING)
+
+    def changed_keys(self, since):
+        """
+        Yields (keys, highest) batches of the source keys whose field is at
+        or above since, with the highest field value it is safe to resume
+        from. Values equal to since are re-read so writes sharing the
+        watermark's timestamp are not lost; re-updating them is a no-op.
+
+        Documents without a key yet are skipped, and highest stops at the
+        first of them: giving them a key later does not touch field, so
+        they would otherwise never be seen again.
+        """
+
+        key = self.source_collection.key
+        documents = self.source_collection.mongo.scan(self._match({self.field: {"$gte": since}}),
+                                                      {key: 1, self.field: 1}, batch_size=self.batch_size,
+                                                      sort=self.field, no_timeout=True, raw_batches=True)
+
+        held_at = None
+
+        for batch in documents:
+
+            keys = []
+
+            for d in batch:
+
+                if d.get(key) is not None:
+
+                    keys.append(d[key])
+
+                elif held_at is None:
+
+                    held_at = d[self.field]
+                    print "Holding the watermark at {0}: {1} {2} has no {3} yet".format(
+                        held_at, self.field, d.get("_id"), key)
+
+            yield keys, batch[-1][self.field] if held_at is None else held_at
+
+    def _sync_batch(self, keys, provider_managed):
+
+        destination = self.destination_collection
+        existing = {d[destination.key] for d in destination.get_many(keys, fields={destination.key: 1})}
+
+        keys_to_insert = [k for k in keys if k not in existing]
+        keys_to_update = [k for k in keys if k in existing and k not in provider_managed]
+
+        if keys_to_insert:
+
+            destination.insert(keys_to_insert)
+
+        if keys_to_update:
+
+            destination.update(keys_to_update)
+
+    def run(self):
+        """
+        Syncs the changes since the stored watermark and advances it after
+        every batch, so an interrupted run resumes where it stopped.
+        Returns the number of source documents considered.
+        """
+
+        since = self.watermark()
+        dryrun = getattr(self.destination_collection, "dryrun", False)
+
+        if since is None:
+
+            # Read the mark before syncing so changes made during the full
+            # sync are picked up by the next incremental run.
+            highest = self._initial_watermark()
+
+            NoodleSyncPlanner(self.source_collection, self.destination_collection, self.batch_size,
+                              self.skip_provider_managed).run()
+
+            if highest is not None and not dryrun:
+
+                self.set_watermark(highest)
+
+            return self.source_collection.count()
+
+        self.destination_collection.set_source_collection(self.source_collection)
+
+        provider_managed = self.destination_collection.provider_managed_keys() \
+            if self.skip_provider_managed else ()
+
+        considered = 0
+
+        for keys, highest in self.changed_keys(since):
+
+            self._sync_batch(keys, provider_managed)
+            considered += len(keys)
+
+            if not dryrun:
+
+                self.set_watermark(highest)
+
+        print "SYNCED {0} documents changed since {1}".format(considered, since)
+
+        return considered
@@ -18,7 +18,7 @@ readme = open('README.md').read()
 
 setup(
     name='dborutils',
-    version='0.4.7',
+    version='0.4.32',
     description='DBOR Utilities contains code shared between multiple Noodle repositories.',
     long_description=readme,
     author='Noodle',
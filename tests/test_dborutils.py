@@ -4,13 +4,70 @@
 Tests for the dborutils repo.
 """
 
+import json
+import random
+import os
 import re
-from mock import patch
+import shutil
+import tempfile
+from bson import Binary, ObjectId
+from datetime import datetime, timedelta
+from mock import MagicMock, patch
+from pymongo.cursor import Cursor
+from pymongo.errors import BulkWriteError
 from unittest import TestCase
 import unittest
 
-from dborutils.mongo_client import NoodleMongoClient
+from dborutils.async_mongo import AsyncCollection, MongoExecutor, NoodleAsyncMongoClient, gather
+from dborutils.bloom_filter import BloomFilter
+from dborutils.key_encoding import BASE36_DIGITS, random_base36_batch
+from dborutils.mongo_client import MongoClientRegistry, NoodleMongoClient
 from dborutils.key_service import NoodleKeyService
+from dborutils.mongo import MongoCollection, NoodleProductionCollection
+from dborutils.search import build_facets, clear_slug_cache, get_slug_label_facet_value, landing_page_slugify
+from dborutils.sync import NoodleIncrementalSync, NoodleSyncPlanner
+
+
+def legacy_landing_page_slugify(value):
+    # The original sequential implementation, kept as the golden reference.
+    value = re.sub('À|Á|Â|Ã|Ä|Å', 'A', value)
+    value = re.sub('à|á|â|ã|ä|å', 'a', value)
+    value = re.sub('È|É|Ê|Ë', 'E', value)
+    value = re.sub('è|é|ê|ë', 'e', value)
+    value = re.sub('ì|í|î|ï', 'i', value)
+    value = re.sub('ñ', 'n', value)
+    value = re.sub('Ñ', 'N', value)
+    value = re.sub('ó|ō|ö', 'o', value)
+    value = re.sub('Ó|Ō|Ö', 'O', value)
+    value = re.sub('ù|ú|ü', 'u', value)
+    value = re.sub('Ù|Ú|Ü', 'U', value)
+    value = re.sub('_', ' ', value)
+    value = re.sub('\W+', '-', value)
+    value = re.sub('\-{2,}', '-', value)
+    return value.strip('-').lower()
+
+
+def production_collection(source_document, destination_documents=(), **kwargs):
+    """
+    A NoodleProductionCollection whose mocked client.find() serves the
+    projected destination_documents to the real get_many(), with a source
+    collection building source_document(key) for every key asked for.
+    """
+    client = MagicMock()
+
+    def find(match, fields=None):
+        keys = match["nice_key"]["$in"]
+        return [{f: v for f, v in d.items() if fields is None or f in fields or f == "_id"}
+                for d in destination_documents if d["nice_key"] in keys]
+
+    client.find.side_effect = find
+
+    collection = NoodleProductionCollection(client, queue_manager=MagicMock(), **kwargs)
+    source = MagicMock()
+    source._get_many_by_key.side_effect = lambda keys: {k: dict(source_document(k), _id=k) for k in keys}
+    collection.set_source_collection(source)
+
+    return collection
 
 
 class TestDborutils(TestCase):
@@ -75,6 +132,200 @@ class TestDborutils(TestCase):
         with self.assertRaises(Exception):
             NoodleMongoClient.parse_db_argstring(mongo_spec)
 
+    @patch('dborutils.mongo_client.MongoClient')
+    def test_clients_for_the_same_uri_share_one_mongo_client(self, mongo_client):
+        self.addCleanup(MongoClientRegistry.close_all)
+        mongo_client.return_value.database_names.return_value = ['local']
+        mongo_client.return_value.__getitem__.return_value.collection_names.return_value = ['a', 'b']
+
+        first = NoodleMongoClient.create_from_mongo_spec('127.0.0.1:local:a')
+        second = NoodleMongoClient.create_from_mongo_spec('127.0.0.1:local:b')
+        NoodleMongoClient.create_from_mongo_spec('noodle:pass@127.0.0.1:local:a')
+
+        self.assertIs(first.client(), second.client())
+        self.assertEqual(mongo_client.call_count, 2)
+
+        first.close()
+        first.disconnect()
+        self.assertFalse(mongo_client.return_value.close.called)
+        self.assertFalse(mongo_client.return_value.disconnect.called)
+
+    @patch('dborutils.mongo_client.MongoClient')
+    def test_registry_configure_keeps_unset_options_and_recycles_without_closing(self, mongo_client):
+        self.addCleanup(MongoClientRegistry.close_all)
+        self.addCleanup(setattr, MongoClientRegistry, 'max_pool_size', MongoClientRegistry.max_pool_size)
+        self.addCleanup(setattr, MongoClientRegistry, 'max_lifetime', MongoClientRegistry.max_lifetime)
+        mongo_client.side_effect = lambda *args, **kwargs: MagicMock()
+
+        MongoClientRegistry.configure(max_lifetime=-1)
+        MongoClientRegistry.configure(max_pool_size=50)
+        self.assertEqual((MongoClientRegistry.max_pool_size, MongoClientRegistry.max_lifetime), (50, -1))
+
+        old = MongoClientRegistry.get('mongodb://127.0.0.1:27017/local')
+        new = MongoClientRegistry.get('mongodb://127.0.0.1:27017/local')
+
+        self.assertIsNot(old, new)
+        self.assertFalse(old.close.called)
+
+    @patch('dborutils.mongo_client.MongoClient')
+    def test_catalog_checks_are_cached_per_shared_client(self, mongo_client):
+        self.addCleanup(MongoClientRegistry.close_all)
+        shared = mongo_client.return_value
+        shared.database_names.return_value = ['local']
+        shared.__getitem__.return_value.name = 'local'
+        shared.__getitem__.return_value.collection_names.return_value = ['a', 'categories']
+
+        client = NoodleMongoClient.create_from_mongo_spec('127.0.0.1:local:a')
+        NoodleMongoClient.create_from_mongo_spec('127.0.0.1:local:a')
+        client.category_collection()
+        client.category_collection()
+
+        self.assertEqual(shared.database_names.call_count, 1)
+        self.assertEqual(shared.__getitem__.return_value.collection_names.call_count, 1)
+
+        with self.assertRaises(KeyError):
+            NoodleMongoClient.create_from_mongo_spec('127.0.0.1:local:missing')
+        self.assertEqual(shared.__getitem__.return_value.collection_names.call_count, 2)
+
+        NoodleMongoClient('mongodb://127.0.0.1:27017/local', 'other', 'missing', validate=False)
+        self.assertEqual(shared.database_names.call_count, 1)
+
+    @patch('dborutils.mongo_client.MongoClient')
+    def test_category_lookups_load_categories_once(self, mongo_client):
+        self.addCleanup(MongoClientRegistry.close_all)
+        database = mongo_client.return_value.__getitem__.return_value
+        database.name = 'local'
+        mongo_client.return_value.database_names.return_value = ['local']
+        database.collection_names.return_value = ['schools', 'colleges', 'categories']
+        collection = database.__getitem__.return_value
+        collection.name = 'schools'
+        collection.find.return_value = [{"collection": "schools", "code": "sc"},
+                                        {"collection": "colleges", "code": "co"}]
+
+        client = NoodleMongoClient.create_from_mongo_spec('127.0.0.1:local:schools')
+
+        self.assertEqual(client.get_category_code(), "sc")
+        self.assertEqual(client.get_category_code(), "sc")
+        self.assertEqual(collection.find.call_count, 1)
+
+        client.invalidate_category_cache()
+        client.get_category()
+        self.assertEqual(collection.find.call_count, 2)
+
+    @patch('dborutils.mongo_client.MongoClient')
+    def test_ensure_indexes_reads_the_index_catalog_once(self, mongo_client):
+        self.addCleanup(MongoClientRegistry.close_all)
+        database = mongo_client.return_value.__getitem__.return_value
+        database.name = 'local'
+        mongo_client.return_value.database_names.return_value = ['local']
+        database.collection_names.return_value = ['schools']
+        collection = database.__getitem__.return_value
+        collection.name = 'schools'
+        collection.index_information.return_value = {
+            "_id_": {"key": [("_id", 1)]},
+            "nice_key_1": {"key": [("nice_key", 1.0)], "unique": True},
+        }
+        collection.create_index.return_value = "state_1_city_-1"
+
+        client = NoodleMongoClient.create_from_mongo_spec('127.0.0.1:local:schools')
+        specs = [{"key": "nice_key", "unique": True}, {"key": [("state", 1), ("city", -1)]}]
+
+        self.assertEqual(client.ensure_indexes(specs), [None, "state_1_city_-1"])
+        self.assertEqual(client.ensure_indexes(specs), [None, None])
+        self.assertEqual(collection.index_information.call_count, 1)
+        collection.create_index.assert_called_once_with(
+            [("state", 1), ("city", -1)], unique=False, sparse=True, background=True)
+
+    @patch('dborutils.mongo_client.MongoClient')
+    def test_ensure_indexes_accepts_a_single_field_index_in_either_direction(self, mongo_client):
+        self.addCleanup(MongoClientRegistry.close_all)
+        database = mongo_client.return_value.__getitem__.return_value
+        database.name = 'local'
+        mongo_client.return_value.database_names.return_value = ['local']
+        database.collection_names.return_value = ['schools']
+        collection = database.__getitem__.return_value
+        collection.name = 'schools'
+        collection.index_information.return_value = {
+            "nice_key_1": {"key": [("nice_key", 1)]},
+            "nice_key_-1": {"key": [("nice_key", -1)], "unique": True},
+        }
+
+        client = NoodleMongoClient.create_from_mongo_spec('127.0.0.1:local:schools')
+
+        self.assertEqual(client.ensure_indexes([{"key": "nice_key", "unique": True}]), [None])
+        self.assertFalse(collection.create_index.called)
+
+    def test_instrumented_counts_and_abandoned_scans_are_recorded(self):
+        client = NoodleMongoClient.__new__(NoodleMongoClient)
+        client._collection = MagicMock()
+        client._collection.name = 'schools'
+        cursor = client._collection.find.return_value = MagicMock(spec=Cursor)
+        cursor.batch_size.return_value = cursor
+        cursor.count.return_value = 7
+        cursor.next.side_effect = [{"a": 1}, {"a": 2}]
+        stats = client.instrument()
+
+        self.assertTrue(NoodleKeyService(source_client=client)._is_nice_key_unique("yzabc") is False)
+        self.assertEqual(stats.get("count", "schools").documents, 7)
+        self.assertIsNone(stats.get("find", "schools"))
+
+        scan = client.scan({})
+        self.assertEqual(next(scan), {"a": 1})
+        scan.close()
+
+        self.assertEqual(stats.get("find", "schools").documents, 1)
+        cursor.close.assert_called_once_with()
+
+    @patch('dborutils.mongo_client.MongoClient')
+    def test_ensure_unique_index_refuses_an_existing_non_unique_index(self, mongo_client):
+        self.addCleanup(MongoClientRegistry.close_all)
+        database = mongo_client.return_value.__getitem__.return_value
+        database.name = 'local'
+        mongo_client.return_value.database_names.return_value = ['local']
+        database.collection_names.return_value = ['schools']
+        collection = database.__getitem__.return_value
+        collection.name = 'schools'
+        collection.index_information.return_value = {"nice_key_1": {"key": [("nice_key", 1)]}}
+
+        client = NoodleMongoClient.create_from_mongo_spec('127.0.0.1:local:schools')
+
+        with self.assertRaisesRegexp(KeyError, "not unique"):
+            client.ensure_index("nice_key", unique=True)
+        self.assertFalse(collection.create_index.called)
+
+    def test_instrumented_client_records_operations(self):
+        client = NoodleMongoClient.__new__(NoodleMongoClient)
+        client._collection = MagicMock()
+        client._collection.name = 'schools'
+        client._collection.find_one.return_value = {"nice_key": "abc"}
+        client._collection.update.return_value = {"n": 3}
+
+        client.find_one({"nice_key": "abc"})
+        self.assertIsNone(client.stats())
+
+        events = []
+        stats = client.instrument()
+        stats.add_sink(events.append)
+
+        client.find_one({"nice_key": "abc"})
+        client.insert([{"a": 1}, {"a": 2}])
+        self.assertEqual(client.update({"a": 1}, {"$set": {"b": 2}}, multi=True), {"n": 3})
+        client._collection.remove.return_value = {"n": 2}
+        client.remove({"a": 1}, True)
+
+        with patch.object(client, '_index_catalog', return_value={"a_1": {"key": [("a", 1)]}}):
+            client.ensure_index("a")
+
+        self.assertEqual(stats.get("find_one", "schools").documents, 1)
+        self.assertEqual(stats.get("insert", "schools").documents, 2)
+        self.assertTrue(stats.get("insert", "schools").bytes > 0)
+        self.assertEqual(stats.get("update", "schools").documents, 3)
+        self.assertEqual(stats.get("remove", "schools").documents, 2)
+        self.assertTrue(stats.get("remove", "schools").bytes > 0)
+        self.assertEqual([e["operation"] for e in events],
+                         ["find_one", "insert", "update", "remove", "ensure_indexes"])
+        self.assertIn("insert", stats.report())
+
     def fake_is_unique(self, candidate_nice_key):
         return True
 
@@ -84,5 +335,500 @@ class TestDborutils(TestCase):
         test_key = nks.generate_nice_key(prefix="yz")
         self.assertTrue(re.match("yz\w\w\w\w\w\w\w\w\w\w", test_key))
 
+    def test_generate_nice_keys_regenerates_only_collisions(self):
+        nks = NoodleKeyService()
+        checked = []
+
+        def existing(candidates, client=None):
+            checked.append(candidates)
+            return set(candidates[:2]) if len(checked) == 1 else set()
+
+        with patch.object(nks, '_existing_nice_keys', side_effect=existing):
+            keys = nks.generate_nice_keys(5, prefix="yz")
+
+        self.assertEqual(len(set(keys)), 5)
+        self.assertEqual([len(c) for c in checked], [5, 2])
+        self.assertTrue(all(re.match("yz\w{10}$", k) for k in keys))
+
+    def test_assign_nice_keys_writes_in_bulk_batches(self):
+        source_client = MagicMock()
+        source_client.count.return_value = 5
+        source_client.scan.return_value = iter([{"_id": i} for i in range(5)])
+        source_client.bulk_update.return_value = {"nMatched": 2, "writeErrors": []}
+
+        nks = NoodleKeyService(source_client=source_client)
+        nks.prefix = "yz"
+
+        with patch.object(nks, '_existing_nice_keys', return_value=set()):
+            nks.assign_nice_keys(batch_size=2)
+
+        self.assertEqual(source_client.bulk_update.call_count, 3)
+        self.assertFalse(source_client.update.called)
+        updates = source_client.bulk_update.call_args_list[0][0][0]
+        self.assertEqual([match for match, _ in updates], [{"_id": 0}, {"_id": 1}])
+
+    def test_synchronize_nice_keys_joins_destination_batch(self):
+        source_client = MagicMock()
+        source_client.count.return_value = 3
+        source_client.scan.return_value = iter([
+            {"_id": 1, "synkey": "s1"}, {"_id": 2, "synkey": "s2"}, {"_id": 3, "synkey": "s3"}])
+        source_client.bulk_update.return_value = {"nMatched": 1, "writeErrors": []}
+        destination_client = MagicMock()
+        destination_client.scan.return_value = [
+            {"synkey": "s1", "nice_key": "ab1"}, {"synkey": "s2", "nice_key": "ab2"},
+            {"synkey": "s2", "nice_key": "ab3"}]
+
+        nks = NoodleKeyService(source_client=source_client, destination_client=destination_client)
+
+        with self.assertRaisesRegexp(KeyError, "s2 \(2\), s3 \(0\)"):
+            nks.synchronize_nice_keys()
+
+        self.assertEqual(destination_client.scan.call_count, 1)
+        updates = source_client.bulk_update.call_args[0][0]
+        self.assertEqual(updates, [({"_id": 1}, {"$set": {"nice_key": "ab1", "ids.nice_key": "ab1"}})])
+
+    def test_bloom_filter_has_no_false_negatives_within_its_memory_cap(self):
+        bloom = BloomFilter(10000, error_rate=0.01, max_bytes=1024 * 1024)
+        keys = ["yz{0}".format(i) for i in range(10000)]
+        for key in keys:
+            bloom.add(key)
+
+        self.assertTrue(all(key in bloom for key in keys))
+        self.assertLess(sum("ab{0}".format(i) in bloom for i in range(10000)), 300)
+        self.assertLessEqual(BloomFilter(10 ** 9, max_bytes=1024).size_in_bytes(), 1024)
+
+    def test_seeded_generated_key_filter_skips_database_checks(self):
+        source_client = MagicMock()
+        source_client.count.return_value = 1
+        source_client.scan.return_value = iter([{"nice_key": "yzexisting"}])
+
+        nks = NoodleKeyService(source_client=source_client)
+        nks.seed_generated_key_filter()
+
+        self.assertFalse(nks._remember_nice_key("yzexisting"))
+        self.assertEqual(len(nks.generate_nice_keys(3, prefix="yz")), 3)
+        self.assertFalse(source_client.find.called)
+
+    def test_random_base36_batch_uses_base36_alphabet(self):
+        keys = random_base36_batch(2000, 10)
+
+        self.assertEqual(len(keys), 2000)
+        self.assertTrue(all(len(k) == 10 for k in keys))
+        self.assertEqual(set("".join(keys)), set(BASE36_DIGITS))
+
+    def test_nice_key_longer_than_max_length_is_refused(self):
+        nks = NoodleKeyService()
+
+        with self.assertRaises(ValueError):
+            nks._candidate_nice_key("yz", 21)
+
+    def test_nice_key_pool_drops_keys_reserved_elsewhere(self):
+        destination_client = MagicMock()
+        destination_client.get_category_code.return_value = "yz"
+        reservations = destination_client.database.return_value.__getitem__.return_value
+        reservations.initialize_unordered_bulk_op.return_value.execute.side_effect = BulkWriteError(
+            {"writeErrors": [{"index": 0, "code": 11000}]})
+
+        nks = NoodleKeyService(destination_client=destination_client)
+        nks.NICE_KEY_POOL_SIZE = 3
+        nks.NICE_KEY_POOL_LOW_WATER_MARK = 0
+
+        with patch.object(nks, 'generate_nice_keys', return_value=["yz1", "yz2", "yz3"]):
+            self.assertEqual(nks.take_nice_key(), "yz2")
+
+        destination_client.reset_mock()
+        self.assertEqual(nks.take_nice_key(), "yz3")
+        self.assertFalse(destination_client.method_calls)
+
+    def test_reserved_nice_keys_are_skipped_and_expire(self):
+        source_client = MagicMock()
+        source_client.count.return_value = 0
+        source_client.scan.return_value = iter([])
+        destination_client = MagicMock()
+        destination_client.get_category_code.return_value = "yz"
+        reservations = destination_client.database.return_value.__getitem__.return_value
+        reservations.find.side_effect = lambda match, fields: [{"nice_key": k} for k in match["nice_key"]["$in"][:1]]
+
+        nks = NoodleKeyService(source_client=source_client, destination_client=destination_client)
+        nks.seed_generated_key_filter()
+
+        self.assertEqual(len(nks._existing_nice_keys(["yz1", "yz2"])), 1)
+        self.assertFalse(nks._is_nice_key_unique("yz1"))
+        self.assertFalse(source_client.find.called)
+        reservations.ensure_index.assert_any_call("reserved_at", expireAfterSeconds=nks.NICE_KEY_RESERVATION_TTL)
+
+        stale = datetime.utcnow() - timedelta(seconds=nks.NICE_KEY_RESERVATION_TTL)
+        nks._nice_key_pool("yz").extend([("yz3", stale), ("yz4", datetime.utcnow())])
+        nks.NICE_KEY_POOL_LOW_WATER_MARK = 0
+
+        self.assertEqual(nks.take_nice_key(), "yz4")
+
+    @patch('dborutils.key_service.Pool')
+    def test_assign_nice_keys_parallel_resumes_unfinished_shards(self, pool):
+        checkpoint_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, checkpoint_dir)
+        for number, done in enumerate([True, False]):
+            with open(os.path.join(checkpoint_dir, "shard-{0:04d}.json".format(number)), "w") as f:
+                json.dump({"number": number, "lower": None, "upper": None,
+                           "last_id": "5" * 24 if not done else None, "done": done}, f)
+
+        source_client = MagicMock()
+        nks = NoodleKeyService(source_client=source_client)
+        nks.prefix = "yz"
+        nks.assign_nice_keys_parallel("localhost:db:coll", checkpoint_dir, processes=2, batch_size=10)
+
+        shards = [args[2] for args in pool.return_value.map.call_args[0][1]]
+        self.assertEqual([shard["number"] for shard in shards], [1])
+        self.assertFalse(source_client.id_ranges.called)
+        self.assertEqual(os.listdir(checkpoint_dir), [])
+
+    def test_starting_nice_key_length_grows_with_occupancy(self):
+        source_client = MagicMock()
+        nks = NoodleKeyService(source_client=source_client)
+
+        source_client.count.return_value = 1000
+        self.assertEqual(nks.starting_nice_key_length("yz"), 12)
+
+        nks._occupancy = {}
+        source_client.count.return_value = 10 ** 15
+        self.assertEqual(nks.starting_nice_key_length("yz"), 13)
+
+    def test_nice_key_stats_count_collisions(self):
+        nks = NoodleKeyService()
+
+        with patch.object(nks, '_is_nice_key_unique', side_effect=[False, False, True]):
+            nks.generate_nice_key(prefix="yz")
+
+        stats = nks.nice_key_stats()
+        self.assertEqual((stats["candidates"], stats["collisions"]), (3, 2))
+        self.assertAlmostEqual(stats["collision_rate"], 2 / 3.0)
+
+    def test_key_index_is_built_once_and_refreshed_incrementally(self):
+        client = MagicMock()
+        client.find_one.return_value = {"_id": 2, "nice_key": "ab2", "payload": {}}
+
+        collection = MongoCollection(client)
+        client.scan.reset_mock()
+        client.scan.return_value = [{"_id": 1, "nice_key": "ab1"}, {"_id": 2, "nice_key": "ab2"}]
+
+        self.assertEqual(collection["ab2"]["_id"], 2)
+        self.assertTrue("ab1" in collection)
+        self.assertEqual(client.scan.call_count, 1)
+
+        client.scan.return_value = []
+        self.assertEqual(len(collection), 2)
+        self.assertEqual(client.scan.call_args[0][0], {"_id": {"$gt": 2}})
+
+    def test_scan_streams_batches_within_an_id_range(self):
+        client = NoodleMongoClient.__new__(NoodleMongoClient)
+        client._collection = MagicMock()
+        cursor = client._collection.find.return_value.batch_size.return_value
+        cursor.sort.return_value = cursor
+        cursor.__iter__.return_value = iter([{"_id": i} for i in range(5)])
+
+        batches = list(client.scan({"a": 1}, {"_id": 1}, batch_size=2, sort="_id", no_timeout=True,
+                                   id_range=(0, None), raw_batches=True))
+
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        client._collection.find.assert_called_once_with(
+            {"$and": [{"a": 1}, {"_id": {"$gte": 0}}]}, {"_id": 1}, timeout=False)
+        cursor.sort.assert_called_once_with("_id", 1)
+        cursor.close.assert_called_once_with()
+
+    def test_key_index_answers_misses_locally_and_is_rebuilt_after_ttl(self):
+        client = MagicMock()
+        collection = MongoCollection(client)
+        client.scan.return_value = [{"_id": 1, "nice_key": "ab1"}, {"_id": 2, "nice_key": "ab2"}]
+
+        self.assertFalse("missing" in collection)
+        self.assertTrue("ab1" in collection)
+        self.assertFalse(client.find.called or client.find_one.called)
+
+        client.scan.reset_mock()
+        client.scan.return_value = [{"_id": 2, "nice_key": "ab2"}]
+        collection._key_index_loaded_at -= collection.KEY_INDEX_TTL + 1
+
+        self.assertEqual(len(collection), 1)
+        self.assertEqual(client.scan.call_args[0][0], {})
+
+    def test_get_many_issues_one_query_per_chunk(self):
+        client = MagicMock()
+        client.find.return_value = []
+
+        collection = MongoCollection(client)
+        client.find.reset_mock()
+
+        list(collection.get_many(["ab1", "ab2", "ab3"], chunk_size=2))
+
+        self.assertEqual(client.find.call_count, 2)
+        self.assertEqual(client.find.call_args_list[0][0][0], {"nice_key": {"$in": ["ab1", "ab2"]}})
+        self.assertEqual(client.find.call_args_list[1][0][0], {"nice_key": {"$in": ["ab3"]}})
+
+    def test_get_many_by_key_refuses_keys_matching_several_documents(self):
+        client = MagicMock()
+        collection = MongoCollection(client, key="synkey")
+        client.find.return_value = [{"_id": 1, "synkey": "s1"}, {"_id": 2, "synkey": "s2"},
+                                    {"_id": 3, "synkey": "s2"}]
+
+        with self.assertRaisesRegexp(KeyError, r"\['s2', 's3'\]"):
+            collection._get_many_by_key(["s1", "s2", "s3"])
+
+    def test_update_writes_in_bulk_batches_and_keeps_write_errors(self):
+        keys = ["ab1", "ab2", "ab3"]
+        collection = production_collection(lambda k: {"synkey": k, "nice_key": k, "v": 1},
+                                           [{"_id": "5" * 24, "nice_key": k, "payload": {}} for k in keys],
+                                           write_batch_size=2)
+        client = collection.mongo
+        client.bulk_replace.side_effect = [
+            {"nMatched": 1, "writeErrors": [{"index": 1, "errmsg": "boom"}]},
+            {"nMatched": 1, "writeErrors": []},
+        ]
+
+        collection.update(keys)
+
+        self.assertEqual(client.bulk_replace.call_count, 2)
+        self.assertEqual(collection.updated_document_count(), 2)
+        self.assertEqual(len(collection.write_errors()), 1)
+
+        duplicated = production_collection(lambda k: {"synkey": k, "nice_key": k, "v": 1},
+                                           [{"_id": "5" * 24, "nice_key": "ab1", "payload": {}}] * 2)
+
+        with self.assertRaisesRegexp(KeyError, r"\['ab1'\]"):
+            duplicated.update(["ab1"])
+
+    def test_insert_flushes_count_and_size_capped_chunks(self):
+        collection = production_collection(
+            lambda k: {"synkey": k, "nice_key": k, "text": "x" * (600 if k == "ab5" else 10)}, write_batch_size=3)
+        collection.INSERT_MAX_BYTES = 800
+        client = collection.mongo
+        client.insert.side_effect = lambda documents: range(len(documents))
+        queue_manager = collection.queue_manager
+
+        collection.insert(["ab{0}".format(i) for i in range(7)])
+
+        self.assertEqual([len(call[0][0]) for call in client.insert.call_args_list], [3, 2, 1, 1])
+        self.assertEqual([call[0][0] for call in queue_manager.queue_insert.call_args_list],
+                         [["ab0", "ab1", "ab2"], ["ab3", "ab4"], ["ab5"], ["ab6"]])
+        self.assertEqual(collection.inserted_document_count(), 7)
+
+    def test_update_backfills_payload_hash_of_unchanged_legacy_documents(self):
+        destination = {"_id": "5" * 24, "nice_key": "ab1", "payload": {"synkey": "ab1", "nice_key": "ab1", "v": 1}}
+        collection = production_collection(lambda k: {"synkey": k, "nice_key": k, "v": 1}, [destination])
+        client = collection.mongo
+
+        collection.update(["ab1"])
+
+        fetches = [call[0][1] for call in client.find.call_args_list]
+        self.assertEqual(fetches, [{"nice_key": 1, "payload_hash": 1}, None])
+        self.assertFalse(client.bulk_replace.called)
+        backfill = client.bulk_update.call_args[0][0]
+        self.assertEqual(backfill[0][0], {"_id": "5" * 24})
+
+        destination.update(backfill[0][1]["$set"])
+        client.find.reset_mock()
+        collection.update(["ab1"])
+
+        self.assertEqual([call[0][1] for call in client.find.call_args_list], [{"nice_key": 1, "payload_hash": 1}])
+        self.assertEqual(collection.unchanged_document_count(), 2)
+        self.assertEqual(client.bulk_update.call_count, 1)
+
+    def test_pipelined_update_matches_serial_counters(self):
+        counters = []
+
+        for pipeline_workers, dryrun in ((None, False), ((2, 2, 1), False), ((2, 2, 1), True)):
+            keys = ["ab{0}".format(i) for i in range(10)]
+            collection = production_collection(
+                lambda k: {"synkey": k, "nice_key": k, "v": int(k[2:]) % 2},
+                [{"_id": "5" * 24, "nice_key": k, "payload_hash": NoodleProductionCollection._payload_hash(
+                    {"synkey": k, "nice_key": k, "v": 0})} for k in keys],
+                dryrun=dryrun, write_batch_size=2, pipeline_workers=pipeline_workers)
+            collection.GET_MANY_CHUNK_SIZE = 3
+            collection.mongo.bulk_replace.side_effect = lambda documents, ordered: {
+                "nMatched": len(documents), "writeErrors": []}
+
+            collection.update(keys)
+
+            counters.append((collection.updated_document_count(), collection.unchanged_document_count(),
+                             collection.queue_manager.queue_update.called))
+
+        self.assertEqual(counters, [(5, 5, True), (5, 5, True), (0, 5, False)])
+
+        for pipeline_workers in ((1, 0, 1), (2, 2), (1, 1, 1, 1)):
+            with self.assertRaises(ValueError):
+                NoodleProductionCollection(MagicMock(), pipeline_workers=pipeline_workers)
+
+    def test_docs_equal_compares_payload_hashes(self):
+        payload = {"b": [1, 2], "a": {"y": u"caf\xe9", "x": None}, "nice_key": "ab1"}
+        reordered = {"nice_key": "ab1", "a": {"x": None, "y": u"caf\xe9"}, "b": [1, 2]}
+        payload_hash = NoodleProductionCollection._payload_hash(payload)
+
+        self.assertEqual(payload_hash, NoodleProductionCollection._payload_hash(reordered))
+
+        collection = NoodleProductionCollection.__new__(NoodleProductionCollection)
+        destination = {"nice_key": "ab1", "payload_hash": payload_hash}
+
+        self.assertTrue(collection._docs_equal(reordered, destination))
+        self.assertFalse(collection._docs_equal(dict(reordered, b=[2, 1]), destination))
+
+    def test_payload_hash_keeps_bson_types_apart(self):
+        object_id = ObjectId()
+        moment = datetime(2015, 6, 1, 12, 30)
+        payload_hash = NoodleProductionCollection._payload_hash
+
+        self.assertEqual(len(payload_hash({"a": Binary("\xff\x00"), "b": [{"d": 1, "c": moment}]})), 40)
+        self.assertEqual(payload_hash({"a": [{"d": 1, "c": moment}], "b": object_id}),
+                         payload_hash({"b": object_id, "a": [{"c": moment, "d": 1}]}))
+        self.assertNotEqual(payload_hash({"a": object_id}), payload_hash({"a": str(object_id)}))
+        self.assertNotEqual(payload_hash({"a": moment}), payload_hash({"a": unicode(moment)}))
+        self.assertNotEqual(payload_hash({"a": Binary("abc")}), payload_hash({"a": "abc"}))
+
+    def test_sync_planner_merge_joins_sorted_keys(self):
+        source = MagicMock(key="nice_key", filter={})
+        source.mongo.scan.return_value = [
+            {"nice_key": k} for k in ["ab1", "ab2", "ab4", "ab5", "ab6"]]
+        destination = MagicMock(key="nice_key", filter={})
+        destination.mongo.scan.return_value = [
+            {"nice_key": k} for k in ["ab2", "ab3", "ab5", "ab7"]]
+        destination.provider_managed_keys.return_value = {"ab7"}
+
+        plan = list(NoodleSyncPlanner(source, destination, batch_size=2))
+
+        self.assertEqual(plan, [
+            ("insert", ["ab1", "ab4"]),
+            ("update", ["ab2", "ab5"]),
+            ("insert", ["ab6"]),
+            ("delete", ["ab3"]),
+        ])
+
+    def test_incremental_sync_routes_changed_keys_and_advances_watermark(self):
+        source = MagicMock(key="nice_key", filter={})
+        source.mongo.scan.return_value = [[{"nice_key": "ab1", "last_update": "t1"},
+                                           {"nice_key": "ab2", "last_update": "t2"}]]
+        destination = MagicMock(key="nice_key", dryrun=False)
+        destination.mongo.collection.return_value.name = "schools"
+        destination.get_many.return_value = [{"nice_key": "ab2"}]
+        destination.provider_managed_keys.return_value = set()
+        watermarks = destination.mongo.database.return_value.__getitem__.return_value
+        watermarks.find_one.return_value = {"_id": "schools:last_update", "value": "t0"}
+
+        sync = NoodleIncrementalSync(source, destination)
+        self.assertFalse(source.mongo.ensure_indexes.called)
+        self.assertEqual(sync.run(), 2)
+
+        self.assertEqual(source.mongo.scan.call_args[0][0], {"last_update": {"$gte": "t0"}})
+        destination.insert.assert_called_once_with(["ab1"])
+        destination.update.assert_called_once_with(["ab2"])
+        match, update = watermarks.update.call_args[0]
+        self.assertEqual((match, update["$set"]["value"]), ({"_id": "schools:last_update"}, "t2"))
+
+    def test_incremental_sync_holds_watermark_at_keyless_documents(self):
+        source = MagicMock(key="nice_key", filter={})
+        source.mongo.scan.return_value = [[{"_id": 1, "last_update": "t1"}],
+                                          [{"nice_key": "ab2", "last_update": "t2"}]]
+        destination = MagicMock(key="nice_key", dryrun=False)
+        destination.mongo.collection.return_value.name = "schools"
+        destination.get_many.return_value = []
+        destination.provider_managed_keys.return_value = set()
+        watermarks = destination.mongo.database.return_value.__getitem__.return_value
+        watermarks.find_one.return_value = {"_id": "schools:last_update", "value": "t0"}
+
+        self.assertEqual(NoodleIncrementalSync(source, destination).run(), 1)
+
+        destination.insert.assert_called_once_with(["ab2"])
+        self.assertEqual([call[0][1]["$set"]["value"] for call in watermarks.update.call_args_list], ["t1", "t1"])
+
+    @patch('dborutils.sync.NoodleSyncPlanner')
+    def test_incremental_sync_first_run_holds_watermark_at_keyless_documents(self, planner):
+        source = MagicMock(key="nice_key", filter={})
+        destination = MagicMock(key="nice_key", dryrun=False)
+        destination.mongo.collection.return_value.name = "schools"
+        watermarks = destination.mongo.database.return_value.__getitem__.return_value
+        watermarks.find_one.return_value = None
+        keyless = []
+
+        def find(match, fields):
+            cursor = MagicMock()
+            documents = keyless if "nice_key" in match else [{"last_update": "t3"}]
+            cursor.sort.return_value.limit.return_value = documents
+            return cursor
+
+        source.mongo.find.side_effect = find
+
+        NoodleIncrementalSync(source, destination).run()
+        keyless.append({"last_update": "t1"})
+        NoodleIncrementalSync(source, destination).run()
+
+        self.assertEqual(planner.return_value.run.call_count, 2)
+        self.assertEqual([call[0][1]["$set"]["value"] for call in watermarks.update.call_args_list], ["t3", "t1"])
+        self.assertEqual(source.mongo.find.call_args_list[-1][0][0],
+                         {"nice_key": None, "last_update": {"$exists": True}})
+
+    def test_async_facade_overlaps_collections_with_bounded_concurrency(self):
+        executor = MongoExecutor(concurrency=2)
+        self.addCleanup(executor.close)
+
+        client = MagicMock()
+        client.find.return_value = iter([{"nice_key": "ab1"}])
+        client.find_one.return_value = {"nice_key": "ab1"}
+        async_client = NoodleAsyncMongoClient(client, executor)
+
+        self.assertEqual(gather([async_client.find({}), async_client.find_one({})]),
+                         [[{"nice_key": "ab1"}], {"nice_key": "ab1"}])
+
+        first, second = MagicMock(), MagicMock()
+        first.get_many.return_value = iter([{"nice_key": "ab1"}])
+        results = [AsyncCollection(first, executor).get_many(["ab1"]),
+                   AsyncCollection(second, executor).insert(["ab2"])]
+
+        self.assertEqual(gather(results, timeout=5)[0], [{"nice_key": "ab1"}])
+        second.insert.assert_called_once_with(["ab2"])
+
+        self.addCleanup(MongoExecutor.close_shared)
+        self.assertIs(NoodleAsyncMongoClient(client).executor, AsyncCollection(first).executor)
+        self.assertIs(AsyncCollection(first)._lock, AsyncCollection(first, executor)._lock)
+        self.assertIsNot(AsyncCollection(first)._lock, AsyncCollection(second)._lock)
+
+    def test_landing_page_slugify_matches_legacy_output(self):
+        samples = [
+            '', '---', 'New York', 'Pre-K__12 / Early  Childhood', 'Ciências da Computação',
+            'Año Académico: Öffentliche Schüle!', '_leading and trailing_', 'ōŌ Ñandú 100%',
+            u'Ciências', u'caf\xc3\xa9', u'Niño_ñ', u'\u4e2d\u6587 Chinese', u'--a--b--',
+        ]
+        rng = random.Random(7)
+        alphabet = list('aZ9_- /.&\xc3\xc5\x80\x8d\xa9\xb1\xff') + ['é', 'Ō', 'Ü']
+        samples += [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 12))) for _ in range(500)]
+        samples += [sample.decode('latin-1') for sample in samples if isinstance(sample, str)]
+
+        clear_slug_cache()
+
+        for sample in samples * 2:
+            slug = landing_page_slugify(sample)
+            expected = legacy_landing_page_slugify(sample)
+            self.assertEqual((type(slug), slug), (type(expected), expected), repr(sample))
+
+        self.assertEqual(get_slug_label_facet_value(u'New York'), u'new-york->>New York')
+
+    def test_build_facets_streams_deduplicated_facets(self):
+        documents = [
+            {"state": u"New York", "degree": [u"Bachelor's", u"Master's"]},
+            {"state": u"New York", "degree": None},
+            {"degree": u"Bachelor's"},
+        ] * 3
+        expected = [
+            {field: [get_slug_label_facet_value(value) for value in
+                     (document[field] if isinstance(document[field], list) else [document[field]])]
+             for field in ("state", "degree") if document.get(field) is not None}
+            for document in documents]
+
+        clear_slug_cache()
+
+        with patch('dborutils.search.get_slug_label_facet_value',
+                   side_effect=get_slug_label_facet_value) as facet_value:
+            self.assertEqual(list(build_facets(iter(documents), ["state", "degree"], batch_size=4)), expected)
+
+        self.assertEqual(facet_value.call_count, 3 + 3 + 1)
+
+        self.assertEqual(list(build_facets(documents, ["state", "degree"], batch_size=2, processes=2)), expected)
+
 if __name__ == '__main__':
     unittest.main()